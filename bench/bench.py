@@ -0,0 +1,241 @@
+"""
+End to end load benchmark for the five microservices, without Docker.
+All five Flask apps are started in this process, each on its own localhost port, and the
+service clients are pointed at those ports instead of http://user:5000 and friends.
+A configurable mix of signups, logins, searches and orders is then replayed against them,
+and p50/p95/p99 latency and requests per second are reported per endpoint.
+
+	python bench/bench.py --requests 2000 --concurrency 8
+	python bench/bench.py --mix search_category=5,order=1 --basket-sizes 1,50,200 --json
+
+With --external the workload runs against an already running stack (ports 9000-9004,
+for example `docker compose up`) instead of starting the apps in process.
+"""
+
+import argparse
+import importlib.util
+import json
+import logging
+import math
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ["user", "products", "search", "orders", "logs"]
+DEFAULT_MIX = "signup=1,login=2,search_name=4,search_category=2,order=2"
+PASSWORD = "Loadtest2024pw"
+
+def free_port():
+	with socket.socket() as sock:
+		sock.bind(("127.0.0.1", 0))
+		return sock.getsockname()[1]
+
+def start_services():
+	# Returns the base URL of every service, started in this process on free localhost ports.
+	ports = {name: free_port() for name in SERVICES}
+	for name, port in ports.items():
+		os.environ[f"{name.upper()}_SERVICE_URL"] = f"http://127.0.0.1:{port}"
+	os.environ.setdefault("JWT_KEY_FILE", os.path.join(ROOT, "key.txt"))
+
+	# The apps keep their databases in the working directory, so give them a scratch one.
+	os.chdir(tempfile.mkdtemp(prefix="micro-food-bench-"))
+	sys.path.insert(0, ROOT)
+	logging.getLogger("werkzeug").setLevel(logging.ERROR)
+	from werkzeug.serving import make_server
+
+	for name, port in ports.items():
+		spec = importlib.util.spec_from_file_location(f"{name}_app", os.path.join(ROOT, name, "app.py"))
+		module = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(module)
+		server = make_server("127.0.0.1", port, module.app, threaded=True)
+		threading.Thread(target=server.serve_forever, name=f"{name}-server", daemon=True).start()
+	return {name: f"http://127.0.0.1:{port}" for name, port in ports.items()}
+
+def parse_mix(text):
+	mix = {}
+	for part in text.split(","):
+		name, _, weight = part.partition("=")
+		if name not in OPERATIONS:
+			raise SystemExit(f"unknown operation {name!r}, expected one of {', '.join(OPERATIONS)}")
+		mix[name] = float(weight or 1)
+	return mix
+
+def percentile(values, pct):
+	# Nearest rank percentile of an already sorted list.
+	index = max(0, min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1))
+	return values[index]
+
+class Workload:
+	def __init__(self, urls, args):
+		self.urls = urls
+		self.args = args
+		self.random = random.Random(args.seed)
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.users = []
+		self.products = []
+		self.categories = [f"aisle{i}" for i in range(args.categories)]
+		self.signups = 0
+
+	def session(self):
+		if not hasattr(self.local, "session"):
+			self.local.session = requests.Session()
+		return self.local.session
+
+	def call(self, method, service, path, **kwargs):
+		r = self.session().request(method, self.urls[service] + path, timeout=60, **kwargs)
+		body = r.json() if r.headers.get("Content-Type", "").startswith(("application/json", "text/html")) else None
+		ok = r.status_code == 200 and (body is None or body.get("status") == 1)
+		return ok, body
+
+	def setup(self):
+		for service in SERVICES:
+			self.session().get(self.urls[service] + "/clear", timeout=60)
+		self.create_user("bench_employee", employee=True)
+		self.employee_jwt = self.login("bench_employee")
+		for i in range(self.args.users):
+			self.create_user(f"bench_user{i}")
+		self.users = [(f"bench_user{i}", self.login(f"bench_user{i}")) for i in range(self.args.users)]
+		for i in range(self.args.products):
+			name = f"product{i}"
+			self.call("POST", "products", "/create_product", headers={"Authorization": self.employee_jwt},
+				data={"name": name, "price": f"{1 + i % 50}.{i % 100:02d}", "category": self.categories[i % len(self.categories)]})
+			self.products.append(name)
+
+	def create_user(self, username, employee=False):
+		return self.call("POST", "user", "/create_user", data={
+			"first_name": "bench", "last_name": "runner", "username": username,
+			"email_address": f"{username}@bench.example", "employee": str(employee),
+			"password": PASSWORD, "salt": "benchsalt",
+		})[0]
+
+	def login(self, username):
+		return self.call("POST", "user", "/login", data={"username": username, "password": PASSWORD})[1]["jwt"]
+
+	def pick(self, items):
+		with self.lock:
+			return self.random.choice(items)
+
+	def signup(self):
+		with self.lock:
+			self.signups += 1
+			username = f"bench_signup{self.signups}"
+		return "/create_user", self.create_user(username)
+
+	def login_op(self):
+		username, _ = self.pick(self.users)
+		ok, _ = self.call("POST", "user", "/login", data={"username": username, "password": PASSWORD})
+		return "/login", ok
+
+	def search_name(self):
+		_, jwt = self.pick(self.users)
+		ok, _ = self.call("GET", "search", "/search", headers={"Authorization": jwt}, params={"product_name": self.pick(self.products)})
+		return "/search?product_name", ok
+
+	def search_category(self):
+		_, jwt = self.pick(self.users)
+		ok, _ = self.call("GET", "search", "/search", headers={"Authorization": jwt}, params={"category": self.pick(self.categories)})
+		return "/search?category", ok
+
+	def order(self):
+		_, jwt = self.pick(self.users)
+		size = self.pick(self.args.basket_sizes)
+		basket = [{"product": self.pick(self.products), "quantity": 1 + i % 3} for i in range(size)]
+		ok, _ = self.call("POST", "orders", "/order", headers={"Authorization": jwt}, data={"order": json.dumps(basket)})
+		return f"/order[basket={size}]", ok
+
+OPERATIONS = {
+	"signup": Workload.signup,
+	"login": Workload.login_op,
+	"search_name": Workload.search_name,
+	"search_category": Workload.search_category,
+	"order": Workload.order,
+}
+
+def run(workload, mix, total, concurrency):
+	names = list(mix)
+	weights = [mix[name] for name in names]
+	plan = workload.random.choices(names, weights=weights, k=total)
+	samples = {}
+	samples_lock = threading.Lock()
+
+	def execute(name):
+		start = time.perf_counter()
+		try:
+			endpoint, ok = OPERATIONS[name](workload)
+		except Exception:
+			endpoint, ok = name, False
+		elapsed = time.perf_counter() - start
+		with samples_lock:
+			samples.setdefault(endpoint, []).append((elapsed, ok))
+
+	started = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as pool:
+		list(pool.map(execute, plan))
+	return samples, time.perf_counter() - started
+
+def report(samples, wall_time):
+	rows = []
+	for endpoint in sorted(samples):
+		latencies = sorted(elapsed for elapsed, _ in samples[endpoint])
+		rows.append({
+			"endpoint": endpoint,
+			"requests": len(latencies),
+			"errors": sum(1 for _, ok in samples[endpoint] if not ok),
+			"p50_ms": round(percentile(latencies, 50) * 1000, 2),
+			"p95_ms": round(percentile(latencies, 95) * 1000, 2),
+			"p99_ms": round(percentile(latencies, 99) * 1000, 2),
+			"rps": round(len(latencies) / wall_time, 1),
+		})
+	total = sum(row["requests"] for row in rows)
+	return {"wall_time_s": round(wall_time, 3), "requests": total, "rps": round(total / wall_time, 1), "endpoints": rows}
+
+def print_report(result):
+	header = f"{'endpoint':<28}{'requests':>9}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}"
+	print(header)
+	print("-" * len(header))
+	for row in result["endpoints"]:
+		print(f"{row['endpoint']:<28}{row['requests']:>9}{row['errors']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['rps']:>9}")
+	print("-" * len(header))
+	print(f"{result['requests']} requests in {result['wall_time_s']}s, {result['rps']} req/s")
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("--requests", type=int, default=1000, help="operations to replay after setup")
+	parser.add_argument("--concurrency", type=int, default=8, help="client threads")
+	parser.add_argument("--mix", default=DEFAULT_MIX, help="comma separated operation=weight pairs")
+	parser.add_argument("--basket-sizes", default="1,10,50", help="comma separated order sizes, picked uniformly")
+	parser.add_argument("--users", type=int, default=20, help="users created during setup")
+	parser.add_argument("--products", type=int, default=200, help="products created during setup")
+	parser.add_argument("--categories", type=int, default=10, help="categories the products are spread over")
+	parser.add_argument("--seed", type=int, default=1, help="random seed for the workload")
+	parser.add_argument("--external", action="store_true", help="use the stack already running on ports 9000-9004")
+	parser.add_argument("--json", action="store_true", help="print the report as JSON")
+	args = parser.parse_args()
+	args.basket_sizes = [int(size) for size in args.basket_sizes.split(",")]
+	mix = parse_mix(args.mix)
+
+	if args.external:
+		urls = {name: f"http://127.0.0.1:{9000 + i}" for i, name in enumerate(SERVICES)}
+	else:
+		urls = start_services()
+
+	workload = Workload(urls, args)
+	workload.setup()
+	samples, wall_time = run(workload, mix, args.requests, args.concurrency)
+	result = report(samples, wall_time)
+	if args.json:
+		print(json.dumps(result, indent=2))
+	else:
+		print_report(result)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,4 @@
+"""
+Code shared by the Micro Foods Market microservices.
+Each service image copies this package next to its app.py.
+"""
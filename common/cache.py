@@ -0,0 +1,79 @@
+"""
+In-process caches shared by the microservices.
+LRUCache is a thread safe, size bounded least recently used cache with hit and miss counters.
+Values loaded through get_or_load() are only stored if nothing was invalidated while they were
+being loaded, so a concurrent write can never be overwritten by the stale value it replaced.
+"""
+
+import threading
+from collections import OrderedDict
+
+MISSING = object()
+
+class LRUCache:
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self._data = OrderedDict()
+		self._generation = 0
+		self._lock = threading.Lock()
+
+	def get(self, key, default=MISSING):
+		with self._lock:
+			if key in self._data:
+				self._data.move_to_end(key)
+				self.hits += 1
+				return self._data[key]
+			self.misses += 1
+			return default
+
+	def generation(self):
+		return self._generation
+
+	def put(self, key, value, generation=None):
+		# A generation taken before loading the value keeps stale loads out of the cache.
+		with self._lock:
+			if generation is not None and generation != self._generation:
+				return
+			self._data[key] = value
+			self._data.move_to_end(key)
+			while len(self._data) > self.maxsize:
+				self._data.popitem(last=False)
+
+	def get_or_load(self, key, loader):
+		value = self.get(key)
+		if value is MISSING:
+			generation = self._generation
+			value = loader()
+			self.put(key, value, generation)
+		return value
+
+	def invalidate(self, *keys):
+		with self._lock:
+			self._generation += 1
+			for key in keys:
+				self._data.pop(key, None)
+
+	def invalidate_where(self, predicate):
+		# Drops every entry whose key matches, for entries that cannot be named one by one.
+		with self._lock:
+			self._generation += 1
+			for key in [key for key in self._data if predicate(key)]:
+				del self._data[key]
+
+	def clear(self):
+		with self._lock:
+			self._generation += 1
+			self._data.clear()
+
+	def stats(self):
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				"size": len(self._data),
+				"maxsize": self.maxsize,
+				"hits": self.hits,
+				"misses": self.misses,
+				"hit_ratio": self.hits / lookups if lookups else 0.0,
+			}
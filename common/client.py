@@ -0,0 +1,118 @@
+"""
+HTTP client for calls between the microservices.
+Each downstream service gets one persistent requests Session with a keep-alive connection pool sized for it,
+so connections (and the DNS lookups behind them) are reused instead of being opened per call.
+Every call has explicit connect and read timeouts, is timed in common.metrics and, inside a request,
+carries its X-Request-ID and is recorded as a span by common.tracing. Calls pass the bulkhead and
+circuit breaker of their downstream service (see common.resilience), which may refuse them; a call that
+cannot be sent or is answered with a 5xx raises resilience.Unavailable, and one answered with a 4xx raises
+requests.HTTPError, so an error body is never mistaken for an answer. Responses are requested in
+MessagePack where the service supports it (see common.codec) and may come back compressed.
+"""
+
+import json
+import os
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from common import codec, metrics, resilience, tracing
+
+CONNECT_TIMEOUT = float(os.environ.get("SERVICE_CONNECT_TIMEOUT", "1"))
+READ_TIMEOUT = float(os.environ.get("SERVICE_READ_TIMEOUT", "10"))
+# Connect and read timeout of the invalidation products sends search after every write.
+NOTIFY_TIMEOUT = float(os.environ.get("SEARCH_NOTIFY_TIMEOUT", "0.5"))
+
+class ServiceClient:
+	def __init__(self, name, base_url, pool_size):
+		self.name = name
+		self.base_url = base_url.rstrip("/")
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+		self.session.mount(self.base_url, adapter)
+		self.guard = resilience.Guard(name)
+
+	def request(self, method, path, route=None, **kwargs):
+		# route: the path with its variable parts replaced by placeholders, which labels the call
+		# in metrics and traces so the number of series stays bounded. Defaults to path.
+		route = route or path
+		kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+		span_id, trace_headers = tracing.outbound_headers()
+		kwargs["headers"] = {**codec.accept_header(), **kwargs.get("headers", {}), **trace_headers}
+		probe = self.guard.acquire()
+		ok = False
+		status = "error"
+		wall_start = time.time()
+		start = time.perf_counter()
+		try:
+			try:
+				r = self.session.request(method, self.base_url + path, **kwargs)
+			except requests.RequestException as error:
+				raise resilience.Unavailable(self.name, "error") from error
+			status = str(r.status_code)
+			ok = r.status_code < 500
+			# A shed or failed request answers 5xx with a body that is not a real answer.
+			if not ok:
+				raise resilience.Unavailable(self.name, f"status {r.status_code}")
+			r.raise_for_status()
+			return codec.decode(r)
+		finally:
+			self.guard.release(ok, probe)
+			elapsed = time.perf_counter() - start
+			metrics.observe_downstream(self.name, method, route, status, elapsed)
+			tracing.record_call(span_id, self.name, method, route, status, wall_start, elapsed)
+
+	def get(self, path, params=None):
+		return self.request("GET", path, params=params)
+
+	def post(self, path, data=None):
+		return self.request("POST", path, data=data)
+
+	def trace(self, request_id):
+		return self.request("GET", f"/trace/{request_id}", route="/trace/<request_id>")
+
+class UserClient(ServiceClient):
+	def verify(self, jwt_token):
+		return self.get("/verify", params={"jwt": jwt_token})
+
+class ProductsClient(ServiceClient):
+	def product(self, **params):
+		# One of product_name, category or q (with an optional limit).
+		return self.get("/product", params=params)
+
+	def lookup(self, product_names):
+		return self.post("/products/batch", data={"product_names": json.dumps(product_names)})
+
+	def changes(self, since):
+		return self.get("/changes", params={"since": since})
+
+class LogsClient(ServiceClient):
+	def log_batch(self, events):
+		return self.post("/log/batch", data={"events": json.dumps(events)})
+
+	def last_mod(self, product_names):
+		return self.post("/last_mod/batch", data={"product_names": json.dumps(product_names)})
+
+	def last_mod_changes(self, since):
+		return self.get("/last_mod/changes", params={"since": since})
+
+class SearchClient(ServiceClient):
+	def invalidate(self, product_names, categories):
+		# Sent after every product write, so it must not hold it up for long: /invalidate only
+		# records the write, and once search keeps failing the breaker refuses it at once.
+		data = {"product_names": json.dumps(product_names), "categories": json.dumps(categories)}
+		return self.request("POST", "/invalidate", data=data, timeout=(NOTIFY_TIMEOUT, NOTIFY_TIMEOUT))
+
+def _config(name, default_url, default_pool_size):
+	prefix = name.upper()
+	url = os.environ.get(f"{prefix}_SERVICE_URL", default_url)
+	pool_size = int(os.environ.get(f"{prefix}_POOL_SIZE", default_pool_size))
+	return name, url, pool_size
+
+user = UserClient(*_config("user", "http://user:5000", 10))
+products = ProductsClient(*_config("products", "http://products:5000", 20))
+logs = LogsClient(*_config("logs", "http://logs:5000", 10))
+search = SearchClient(*_config("search", "http://search:5000", 4))
+orders = ServiceClient(*_config("orders", "http://orders:5000", 4))
+
+def services():
+	return [user, products, search, orders, logs]
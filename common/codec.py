@@ -0,0 +1,64 @@
+"""
+Response encoding for calls between the microservices.
+response(obj) answers with the JSON document the handlers have always returned, or with the same object
+in MessagePack when the caller prefers application/msgpack, which is smaller and cheaper to encode and
+decode. common.client asks for it on every call when the msgpack package is installed, and decode()
+reads either format.
+instrument(app) compresses response bodies of at least RESPONSE_COMPRESS_MIN_SIZE bytes with gzip or
+deflate when the caller accepts it. Streamed (NDJSON) responses are sent as they are.
+"""
+
+import gzip
+import json
+import os
+import zlib
+from flask import Response, request
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+JSON_TYPE = "application/json"
+MSGPACK_TYPE = "application/msgpack"
+
+# Format common.client asks for: "msgpack" (when the package is installed) or "json".
+WIRE_FORMAT = os.environ.get("SERVICE_WIRE_FORMAT", "msgpack")
+
+COMPRESS_MIN_SIZE = int(os.environ.get("RESPONSE_COMPRESS_MIN_SIZE", "1024"))
+# Most responses go to other services on the local network, where a fast level beats a high ratio.
+COMPRESS_LEVEL = int(os.environ.get("RESPONSE_COMPRESS_LEVEL", "1"))
+
+def response(obj):
+	if msgpack is not None and request.accept_mimetypes.best_match([JSON_TYPE, MSGPACK_TYPE]) == MSGPACK_TYPE:
+		return Response(msgpack.packb(obj), mimetype=MSGPACK_TYPE, headers={"Vary": "Accept"})
+	return json.dumps(obj)
+
+def accept_header():
+	# The Accept header common.client sends: MessagePack first when it can be decoded, JSON otherwise.
+	if msgpack is None or WIRE_FORMAT != "msgpack":
+		return {}
+	return {"Accept": f"{MSGPACK_TYPE}, {JSON_TYPE};q=0.5"}
+
+def decode(r):
+	if r.headers.get("Content-Type", "").startswith(MSGPACK_TYPE):
+		return msgpack.unpackb(r.content, strict_map_key=False)
+	return r.json()
+
+def compress(body, encoding):
+	if encoding == "gzip":
+		return gzip.compress(body, COMPRESS_LEVEL, mtime=0)
+	return zlib.compress(body, COMPRESS_LEVEL)
+
+def instrument(app):
+	@app.after_request
+	def compress_response(response):
+		if response.is_streamed or response.direct_passthrough or "Content-Encoding" in response.headers:
+			return response
+		encoding = request.accept_encodings.best_match(["gzip", "deflate"])
+		if encoding is None or response.content_length is None or response.content_length < COMPRESS_MIN_SIZE:
+			return response
+		response.set_data(compress(response.get_data(), encoding))
+		response.headers["Content-Encoding"] = encoding
+		response.vary.add("Accept-Encoding")
+		return response
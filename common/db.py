@@ -0,0 +1,211 @@
+"""
+SQLite connection management shared by the microservices.
+Each thread keeps one open connection per database and reuses it across requests instead of
+connecting and closing on every request. Connections run in WAL mode with synchronous=NORMAL,
+so readers and the writer no longer block each other, and use a busy timeout and a larger
+prepared statement cache. Every statement executed through them is timed in common.metrics.
+The schema is created at startup under a file lock, so several worker processes can share one
+database file without re-running the schema script over each other's data.
+Resets copy a template database, built once per process from the schema script and kept in memory,
+over the database file with the SQLite backup API instead of running the script again. Named snapshots
+of a database (a seeded catalog, a set of users) are saved next to it and restored the same way.
+"""
+
+import fcntl
+import os
+import re
+import sqlite3
+import threading
+import time
+from common import metrics
+
+# Seconds a connection waits on a locked database before giving up.
+BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", "5"))
+# Number of prepared statements kept per connection.
+CACHED_STATEMENTS = int(os.environ.get("SQLITE_CACHED_STATEMENTS", "256"))
+
+SNAPSHOT_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+class TimedCursor(sqlite3.Cursor):
+	# Times execute(), which runs the statement up to its first row, and fetchmany()/fetchall(),
+	# which read the rest. fetchone() and iterating over the cursor are not timed, which keeps
+	# their per-row cost at zero.
+	def execute(self, sql, parameters=()):
+		self.statement = sql
+		start = time.perf_counter()
+		try:
+			return super().execute(sql, parameters)
+		finally:
+			metrics.observe_query(self.connection.database_name, sql, "execute", time.perf_counter() - start)
+
+	def executemany(self, sql, seq_of_parameters):
+		self.statement = sql
+		start = time.perf_counter()
+		try:
+			return super().executemany(sql, seq_of_parameters)
+		finally:
+			metrics.observe_query(self.connection.database_name, sql, "execute", time.perf_counter() - start)
+
+	def fetchmany(self, size=None):
+		start = time.perf_counter()
+		try:
+			return super().fetchmany(self.arraysize if size is None else size)
+		finally:
+			self._observe_fetch(start)
+
+	def fetchall(self):
+		start = time.perf_counter()
+		try:
+			return super().fetchall()
+		finally:
+			self._observe_fetch(start)
+
+	def _observe_fetch(self, start):
+		statement = getattr(self, "statement", None)
+		if statement is not None:
+			metrics.observe_query(self.connection.database_name, statement, "fetch", time.perf_counter() - start)
+
+class TimedConnection(sqlite3.Connection):
+	# Connection.execute() and executemany() normally bypass Python level cursor methods,
+	# so they are routed through a TimedCursor here. executescript() (the schema) is not timed.
+	database_name = ""
+
+	def cursor(self, factory=TimedCursor):
+		return super().cursor(factory)
+
+	def execute(self, sql, parameters=()):
+		return self.cursor().execute(sql, parameters)
+
+	def executemany(self, sql, seq_of_parameters):
+		return self.cursor().executemany(sql, seq_of_parameters)
+
+class Database:
+	def __init__(self, path, schema_file, reseed=None):
+		self.path = path
+		self.schema_file = schema_file
+		# SQL run on every copy restored over the database, for values each copy must get anew,
+		# such as the epoch replicas use to notice that a database was replaced.
+		self.reseed = reseed
+		self.snapshot_dir = path + ".snapshots"
+		self._local = threading.local()
+		# In-memory images: the template, and the named snapshots by name with the file's mtime.
+		# They are only used under _images_lock and rebuilt after a fork.
+		self._template = None
+		self._snapshots = {}
+		self._images_lock = threading.Lock()
+		self._images_pid = None
+
+	def connect(self):
+		conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, cached_statements=CACHED_STATEMENTS, factory=TimedConnection)
+		conn.database_name = os.path.basename(self.path)
+		conn.execute("PRAGMA journal_mode = WAL")
+		conn.execute("PRAGMA synchronous = NORMAL")
+		conn.execute("PRAGMA foreign_keys = ON")
+		return conn
+
+	def get(self):
+		# Returns this thread's connection, opening it on first use.
+		conn = getattr(self._local, "conn", None)
+		if conn is None:
+			conn = self.connect()
+			self._local.conn = conn
+		return conn
+
+	def release(self):
+		# Called when a request ends: roll back anything a handler left uncommitted,
+		# so the next request on this thread starts from a clean connection.
+		conn = getattr(self._local, "conn", None)
+		if conn is not None and conn.in_transaction:
+			conn.rollback()
+
+	def init_schema(self, reset=False):
+		# Creates the schema if the database has not been initialized yet (user_version 0), or
+		# replaces the whole database with an empty one with reset=True. The check and the copy
+		# run under an exclusive lock on "<database>.lock" shared by every worker process.
+		with open(self.path + ".lock", "a") as lock_file:
+			fcntl.flock(lock_file, fcntl.LOCK_EX)
+			version = self.get().execute("PRAGMA user_version").fetchone()[0]
+			if not reset and version > 0:
+				return
+			with self._images_lock:
+				self._restore(self._template_image())
+
+	def save_snapshot(self, name):
+		# Saves the current database as snapshot `name`, replacing any previous one.
+		# Raises ValueError for names that are not [A-Za-z0-9_-]{1,64}.
+		path = self._snapshot_path(name)
+		os.makedirs(self.snapshot_dir, exist_ok=True)
+		target = sqlite3.connect(path + ".tmp")
+		try:
+			self.get().backup(target)
+			target.execute("PRAGMA journal_mode = DELETE")
+		finally:
+			target.close()
+		os.replace(path + ".tmp", path)
+
+	def restore_snapshot(self, name):
+		# Replaces the database with snapshot `name`. Raises KeyError if there is no such snapshot.
+		path = self._snapshot_path(name)
+		try:
+			mtime = os.stat(path).st_mtime_ns
+		except FileNotFoundError:
+			raise KeyError(name)
+		with open(self.path + ".lock", "a") as lock_file:
+			fcntl.flock(lock_file, fcntl.LOCK_EX)
+			with self._images_lock:
+				self._check_pid()
+				cached = self._snapshots.get(name)
+				if cached is None or cached[0] != mtime:
+					image = sqlite3.connect(":memory:", check_same_thread=False)
+					source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+					try:
+						source.backup(image)
+					finally:
+						source.close()
+					cached = self._snapshots[name] = (mtime, image)
+				self._restore(cached[1])
+
+	def snapshots(self):
+		try:
+			return sorted(entry[:-3] for entry in os.listdir(self.snapshot_dir) if entry.endswith(".db"))
+		except FileNotFoundError:
+			return []
+
+	def _snapshot_path(self, name):
+		if not SNAPSHOT_NAME_PATTERN.fullmatch(name):
+			raise ValueError(f"invalid snapshot name: {name}")
+		return os.path.join(self.snapshot_dir, name + ".db")
+
+	def _check_pid(self):
+		# SQLite connections must not be used across a fork, so a forked worker builds its own images.
+		if self._images_pid != os.getpid():
+			self._template = None
+			self._snapshots = {}
+			self._images_pid = os.getpid()
+
+	def _template_image(self):
+		self._check_pid()
+		if self._template is None:
+			with open(self.schema_file, 'r') as sql_startup:
+				init_db = sql_startup.read()
+			image = sqlite3.connect(":memory:", check_same_thread=False)
+			image.executescript(f"BEGIN;\n{init_db}\nPRAGMA user_version = 1;\nCOMMIT;")
+			self._template = image
+		return self._template
+
+	def _restore(self, image):
+		# Copies `image` over the database in one step of the backup API. Called with the file lock
+		# and _images_lock held. The image is reseeded first, so the copy is never seen without it.
+		if self.reseed:
+			image.executescript(f"BEGIN;\n{self.reseed}\nCOMMIT;")
+		conn = self.get()
+		if conn.in_transaction:
+			conn.rollback()
+		image.backup(conn)
+
+	def ready(self):
+		# True once the schema exists and the database answers queries.
+		try:
+			return self.get().execute("PRAGMA user_version").fetchone()[0] > 0
+		except sqlite3.Error:
+			return False
@@ -0,0 +1,100 @@
+"""
+Concurrent execution of independent downstream calls.
+gather() takes the calls a handler would otherwise make one after the other, in that order, and runs them
+at the same time: the first one in the calling thread, the later ones on a bounded thread pool per
+downstream service, so the wait approaches the slowest call instead of the sum of all of them, and a
+failure of the first call can still cancel the later ones.
+Each call says which of its results is a failure. A failure makes every later call irrelevant, exactly
+as it would have been skipped by the serial code, so those are cancelled (or no longer waited for if they
+already started), while earlier calls are still awaited because their own failure takes precedence.
+The handler therefore sees the same results, and returns the same status codes, as in serial mode.
+FANOUT_MODE=serial restores one call after the other.
+"""
+
+import contextvars
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+MODE = os.environ.get("FANOUT_MODE", "concurrent")
+# Calls in flight per downstream service and worker process; FANOUT_<SERVICE>_WORKERS overrides it.
+WORKERS = int(os.environ.get("FANOUT_WORKERS", "16"))
+
+# downstream: name of the service called, function: makes the call, failed: tells whether a result is a failure.
+Call = namedtuple("Call", ["downstream", "function", "failed"])
+
+# Result of a call that was skipped because an earlier call failed.
+CANCELLED = object()
+
+executors = {}
+executors_lock = threading.Lock()
+executors_pid = None
+
+def executor(downstream):
+	# Pools are created lazily, and again after a fork, since a forked worker has no pool threads.
+	global executors_pid
+	with executors_lock:
+		if executors_pid != os.getpid():
+			executors.clear()
+			executors_pid = os.getpid()
+		pool = executors.get(downstream)
+		if pool is None:
+			workers = int(os.environ.get(f"FANOUT_{downstream.upper()}_WORKERS", WORKERS))
+			pool = executors[downstream] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"fanout-{downstream}")
+		return pool
+
+def gather(*calls):
+	# Returns one result per call, CANCELLED for calls after the first failure.
+	# An exception raised by a call is re-raised unless an earlier call failed.
+	if MODE == "serial" or len(calls) < 2:
+		return serial(calls)
+
+	# Calls run in the pool with a copy of the caller's context, so they carry its request ID.
+	futures = {index: executor(call.downstream).submit(contextvars.copy_context().run, call.function) for index, call in enumerate(calls) if index > 0}
+	results = [CANCELLED] * len(calls)
+	errors = {}
+	cutoff = len(calls)
+
+	def settle(index, outcome, error):
+		nonlocal cutoff
+		if index >= cutoff:
+			return
+		if error is not None:
+			errors[index] = error
+		else:
+			results[index] = outcome
+			if not calls[index].failed(outcome):
+				return
+		cutoff = index + 1
+		for later, future in futures.items():
+			if later >= cutoff:
+				future.cancel()
+
+	try:
+		settle(0, calls[0].function(), None)
+	except Exception as error:
+		settle(0, None, error)
+
+	pending = {future: index for index, future in futures.items()}
+	while any(index < cutoff for index in pending.values()):
+		done, _ = wait(pending, return_when=FIRST_COMPLETED)
+		for future in done:
+			index = pending.pop(future)
+			if future.cancelled():
+				continue
+			error = future.exception()
+			settle(index, None if error else future.result(), error)
+
+	for index in range(cutoff):
+		if index in errors:
+			raise errors[index]
+	return [result if index < cutoff else CANCELLED for index, result in enumerate(results)]
+
+def serial(calls):
+	results = [CANCELLED] * len(calls)
+	for index, call in enumerate(calls):
+		results[index] = call.function()
+		if call.failed(results[index]):
+			break
+	return results
@@ -0,0 +1,22 @@
+"""
+Gunicorn settings for the production serving mode (see common/serve.sh).
+Every service listens on port 5000 inside its container; WEB_WORKERS and WEB_THREADS size the
+worker pool. Each worker imports app.py, which creates the schema under a file lock if needed.
+Workers publish their metrics and spans to a fresh METRICS_DIR and TRACE_DIR, so /metrics and
+/trace report the whole service.
+"""
+
+import multiprocessing
+import os
+import tempfile
+
+bind = "0.0.0.0:5000"
+# gthread, plus the queue time common.resilience sheds on (see common/gunicorn_worker.py).
+worker_class = "common.gunicorn_worker.QueueTimedWorker"
+workers = int(os.environ.get("WEB_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.environ.get("WEB_THREADS", "8"))
+timeout = int(os.environ.get("WEB_TIMEOUT", "30"))
+keepalive = 5
+
+os.environ.setdefault("METRICS_DIR", tempfile.mkdtemp(prefix="metrics-"))
+os.environ.setdefault("TRACE_DIR", tempfile.mkdtemp(prefix="traces-"))
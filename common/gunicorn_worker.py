@@ -0,0 +1,26 @@
+"""
+The gthread worker used in the production serving mode (see common/gunicorn.conf.py), which also
+records when each request was queued for a worker thread.
+A gthread worker runs at most WEB_THREADS requests at a time, and connections beyond that wait in
+its thread pool queue where the application cannot see them. This worker stamps every request with
+an X-Request-Start header (t=<microseconds>, the convention load balancers use) taken when its
+connection was queued, so common.resilience can shed requests that already waited too long.
+"""
+
+import time
+from gunicorn.workers.gthread import ThreadWorker
+
+HEADER = "X-REQUEST-START"
+
+class QueueTimedWorker(ThreadWorker):
+	def enqueue_req(self, conn):
+		conn.queued_at = time.time()
+		super().enqueue_req(conn)
+
+	def handle_request(self, req, conn):
+		# Replaces any value the client sent; the header names gunicorn parses are upper case.
+		queued_at = getattr(conn, "queued_at", None)
+		if queued_at is not None:
+			req.headers = [(name, value) for name, value in req.headers if name != HEADER]
+			req.headers.append((HEADER, f"t={int(queued_at * 1000000)}"))
+		return super().handle_request(req, conn)
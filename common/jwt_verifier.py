@@ -0,0 +1,100 @@
+"""
+JWT signing and verification shared by every microservice.
+The signing key is read from key.txt once per process and HS256 signatures are checked locally,
+so services no longer need a round trip to the user service to validate a token.
+The employee flag still lives in the users database; it is fetched from the user service and cached for a short time,
+for at most JWT_USER_CACHE_SIZE users per process.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from common import client
+from common.cache import LRUCache, MISSING
+
+key_file = os.environ.get("JWT_KEY_FILE", "key.txt")
+
+# Seconds a user service answer is reused before it is looked up again.
+EMPLOYEE_TTL = float(os.environ.get("JWT_EMPLOYEE_TTL", "5"))
+# Users whose answer is kept; the least recently used are dropped first.
+USER_CACHE_SIZE = int(os.environ.get("JWT_USER_CACHE_SIZE", "10000"))
+
+_key = None
+_key_lock = threading.Lock()
+_user_cache = LRUCache(USER_CACHE_SIZE)
+
+def load_key():
+	global _key
+	if _key is None:
+		with _key_lock:
+			if _key is None:
+				with open(key_file, "r") as f:
+					_key = f.readline().strip().encode('utf-8')
+	return _key
+
+def sign(signing_input):
+	return hmac.new(load_key(), signing_input.encode('utf-8'), hashlib.sha256).hexdigest()
+
+def generate_jwt(username):
+	try:
+		load_key()
+	except Exception:
+		raise Exception("JWT key file not found or unreadable.")
+
+	header = {"alg": "HS256", "typ": "JWT"}
+	payload = {"username": username}
+
+	# Base64 URL safe encode the JSON header and payload.
+	header_b64 = base64.urlsafe_b64encode(json.dumps(header).encode('utf-8')).decode('utf-8')
+	payload_b64 = base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('utf-8')
+
+	signature = sign(f"{header_b64}.{payload_b64}")
+	return f"{header_b64}.{payload_b64}.{signature}"
+
+def verify_jwt(token):
+	# Returns the decoded payload, or None if the token is malformed or the signature does not match.
+	try:
+		parts = token.split('.')
+		if len(parts) != 3:
+			return None
+		header_b64, payload_b64, sig = parts
+		if not hmac.compare_digest(sign(f"{header_b64}.{payload_b64}"), sig):
+			return None
+		return json.loads(base64.urlsafe_b64decode(payload_b64).decode('utf-8'))
+	except Exception:
+		return None
+
+def token_username(token):
+	# Returns the username of a correctly signed token, or None. Needs no other service.
+	payload = verify_jwt(token)
+	if payload is None or "username" not in payload:
+		return None
+	return payload["username"]
+
+def verify(token):
+	# Returns the same dictionary as the user service /verify endpoint.
+	username = token_username(token)
+	if username is None:
+		return {"status": 2, "user": "NULL", "employee": "NULL"}
+
+	now = time.monotonic()
+	cached = _user_cache.get(username)
+	if cached is not MISSING:
+		if cached[0] > now:
+			return dict(cached[1])
+		_user_cache.invalidate(username)
+
+	# Only the employee flag (and whether the user still exists) needs the user service.
+	# A call that is not answered with a 200 raises, so only real answers are cached.
+	user_data = client.user.verify(token)
+	if user_data.get("status") not in (1, 2):
+		return dict(user_data)
+	_user_cache.put(username, (now + EMPLOYEE_TTL, user_data))
+	return dict(user_data)
+
+def clear_cache():
+	_user_cache.clear()
@@ -0,0 +1,129 @@
+"""
+Client side log shipping shared by every microservice.
+Events are buffered in memory and sent to the logs service /log/batch endpoint through common.client from a background thread,
+either when enough events have piled up or when the flush interval has passed.
+A single sender thread ships batches in the order they were logged, so event order per producer is kept.
+A batch is retried while the logs service is unavailable; events it rejects are dropped and counted
+in log_events_dropped_total, like the oldest events when the buffer overflows.
+"""
+
+import os
+import threading
+import time
+from common import client, metrics, resilience
+
+# A batch is sent as soon as it holds this many events...
+BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "100"))
+# ...or once the oldest buffered event has waited this many seconds.
+FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "0.05"))
+# Events beyond this bound are dropped (oldest first) while the logs service is unreachable.
+MAX_BUFFER = int(os.environ.get("LOG_MAX_BUFFER", "100000"))
+
+metrics.registry.define("log_events_dropped_total", "counter", "Log events given up on, by reason (rejected by the logs service or buffer overflow).")
+
+class LogShipper:
+	def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, max_buffer=MAX_BUFFER):
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.max_buffer = max_buffer
+		self.dropped = 0
+		self.rejected = 0
+		self._buffer = []
+		self._logged = 0
+		self._shipped = 0
+		self._flush_target = 0
+		self._cond = threading.Condition()
+		self._thread = None
+		self._pid = None
+
+	def log(self, event, user, name):
+		self.log_many([{"event": event, "user": user, "name": name}])
+
+	def log_many(self, events):
+		with self._cond:
+			self._ensure_thread()
+			self._buffer.extend(events)
+			self._logged += len(events)
+			self._trim()
+			self._cond.notify_all()
+
+	def flush(self, timeout=None):
+		# Block until every event logged before this call has been shipped (or dropped).
+		deadline = None if timeout is None else time.monotonic() + timeout
+		with self._cond:
+			target = self._logged
+			self._flush_target = max(self._flush_target, target)
+			self._cond.notify_all()
+			while self._shipped < target:
+				remaining = None if deadline is None else deadline - time.monotonic()
+				if remaining is not None and remaining <= 0:
+					return False
+				self._cond.wait(remaining)
+		return True
+
+	def _trim(self):
+		overflow = len(self._buffer) - self.max_buffer
+		if overflow > 0:
+			del self._buffer[:overflow]
+			self.dropped += overflow
+			self._shipped += overflow
+			metrics.registry.inc("log_events_dropped_total", (("reason", "overflow"),), overflow)
+
+	def _ensure_thread(self):
+		# Started lazily so that forked worker processes each get their own sender thread.
+		if self._thread is None or self._pid != os.getpid():
+			self._pid = os.getpid()
+			self._thread = threading.Thread(target=self._run, name="log-shipper", daemon=True)
+			self._thread.start()
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._buffer:
+					self._cond.wait()
+				# Give the batch a chance to fill up before sending it, unless someone is waiting on a flush.
+				deadline = time.monotonic() + self.flush_interval
+				while len(self._buffer) < self.batch_size and self._shipped >= self._flush_target:
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						break
+					self._cond.wait(remaining)
+				batch = self._buffer[:self.batch_size]
+				del self._buffer[:self.batch_size]
+
+			# Only an unavailable logs service is worth retrying; a batch or event it rejects
+			# would be rejected again and hold up every event logged after it.
+			try:
+				answer = client.logs.log_batch(batch)
+				sent = True
+				rejected = len(batch) if answer.get("status") != 1 else answer.get("rejected", 0)
+			except resilience.Unavailable:
+				sent = False
+			except Exception:
+				sent = True
+				rejected = len(batch)
+
+			with self._cond:
+				if sent:
+					self._shipped += len(batch)
+					if rejected:
+						self.rejected += rejected
+						metrics.registry.inc("log_events_dropped_total", (("reason", "rejected"),), rejected)
+				else:
+					# Put the batch back in front so it is retried before anything logged after it.
+					self._buffer[0:0] = batch
+					self._trim()
+				self._cond.notify_all()
+			if not sent:
+				time.sleep(self.flush_interval)
+
+shipper = LogShipper()
+
+def log_event(event, user, name):
+	shipper.log(event, user, name)
+
+def log_events(events):
+	shipper.log_many(events)
+
+def flush(timeout=None):
+	return shipper.flush(timeout)
@@ -0,0 +1,190 @@
+"""
+Prometheus metrics shared by the microservices.
+instrument(app, service) times every request by route, method and status code and adds GET /metrics,
+which returns the collected counters and histograms in the Prometheus text format. common.client times
+every outbound call and common.db every SQLite query through the same registry.
+Recording a sample only takes a lock and a few additions. When METRICS_DIR is set (gunicorn does this),
+each worker process writes its samples to a file in that directory every METRICS_SYNC_INTERVAL seconds
+and /metrics adds up the files of all workers, so a scrape sees the whole service and not one worker.
+"""
+
+import bisect
+import json
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+from flask import Response, g, request
+
+METRICS_DIR = os.environ.get("METRICS_DIR")
+SYNC_INTERVAL = float(os.environ.get("METRICS_SYNC_INTERVAL", "1"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+
+class Registry:
+	def __init__(self):
+		self._definitions = {}
+		self._counters = {}
+		self._histograms = {}
+		self._lock = threading.Lock()
+		self._thread = None
+		self._pid = None
+
+	def define(self, name, kind, help_text, buckets=None):
+		self._definitions[name] = (kind, help_text, buckets)
+
+	def inc(self, name, labels, amount=1):
+		# labels is a tuple of (name, value) pairs, in the same order for every sample of a metric.
+		key = (name, labels)
+		with self._lock:
+			self._counters[key] = self._counters.get(key, 0) + amount
+
+	def observe(self, name, labels, value):
+		buckets = self._definitions[name][2]
+		key = (name, labels)
+		with self._lock:
+			counts = self._histograms.get(key)
+			if counts is None:
+				# One count per bucket, one for +Inf, then the sum of all observed values.
+				counts = self._histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+			counts[bisect.bisect_left(buckets, value)] += 1
+			counts[-1] += value
+
+	def snapshot(self):
+		with self._lock:
+			return {
+				"counters": [[name, labels, value] for (name, labels), value in self._counters.items()],
+				"histograms": [[name, labels, list(counts)] for (name, labels), counts in self._histograms.items()],
+			}
+
+	def ensure_writer(self):
+		# Started lazily so that forked worker processes each write their own file.
+		if METRICS_DIR and (self._thread is None or self._pid != os.getpid()):
+			with self._lock:
+				if self._thread is not None and self._pid == os.getpid():
+					return
+				self._pid = os.getpid()
+				self._thread = threading.Thread(target=self._run_writer, name="metrics-writer", daemon=True)
+				self._thread.start()
+
+	def _run_writer(self):
+		while True:
+			time.sleep(SYNC_INTERVAL)
+			try:
+				self.write_file()
+			except OSError:
+				pass
+
+	def write_file(self):
+		os.makedirs(METRICS_DIR, exist_ok=True)
+		path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+		with open(path + ".tmp", "w") as out:
+			json.dump(self.snapshot(), out)
+		os.replace(path + ".tmp", path)
+
+	def collect(self):
+		# This process's samples plus the last ones written by every other worker.
+		snapshots = [self.snapshot()]
+		if METRICS_DIR and os.path.isdir(METRICS_DIR):
+			own = f"{os.getpid()}.json"
+			for entry in os.listdir(METRICS_DIR):
+				if entry.endswith(".json") and entry != own:
+					try:
+						with open(os.path.join(METRICS_DIR, entry)) as snapshot_file:
+							snapshots.append(json.load(snapshot_file))
+					except (OSError, ValueError):
+						continue
+		counters = {}
+		histograms = {}
+		for snapshot in snapshots:
+			for name, labels, value in snapshot["counters"]:
+				key = (name, tuple(tuple(pair) for pair in labels))
+				counters[key] = counters.get(key, 0) + value
+			for name, labels, counts in snapshot["histograms"]:
+				key = (name, tuple(tuple(pair) for pair in labels))
+				total = histograms.get(key)
+				histograms[key] = list(counts) if total is None else [a + b for a, b in zip(total, counts)]
+		return counters, histograms
+
+	def render(self):
+		counters, histograms = self.collect()
+		lines = []
+		for name, (kind, help_text, buckets) in sorted(self._definitions.items()):
+			series = counters if kind == "counter" else histograms
+			keys = sorted(key for key in series if key[0] == name)
+			if not keys:
+				continue
+			lines.append(f"# HELP {name} {help_text}")
+			lines.append(f"# TYPE {name} {kind}")
+			for key in keys:
+				labels = key[1]
+				if kind == "counter":
+					lines.append(f"{name}{format_labels(labels)} {format_value(series[key])}")
+					continue
+				counts = series[key]
+				cumulative = 0
+				for bound, count in zip(buckets + ("+Inf",), counts):
+					cumulative += count
+					le = bound if bound == "+Inf" else format_value(bound)
+					lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+				lines.append(f"{name}_sum{format_labels(labels)} {format_value(counts[-1])}")
+				lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+		return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+	if not labels:
+		return ""
+	pairs = (f'{key}="{escape(value)}"' for key, value in labels)
+	return "{" + ",".join(pairs) + "}"
+
+def escape(value):
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_value(value):
+	return format(value, "g") if isinstance(value, float) else str(value)
+
+def normalize_sql(sql):
+	# Statement label for a query: whitespace collapsed, IN lists of any length folded into one
+	# label, and long statements cut short, so the number of series stays bounded.
+	statement = " ".join(sql.split())
+	statement = re.sub(r"IN \((\?, ?)*\?\)", "IN (...)", statement, flags=re.IGNORECASE)
+	return statement[:160]
+
+registry = Registry()
+registry.define("http_requests_total", "counter", "HTTP requests handled, by route, method and status code.")
+registry.define("http_request_duration_seconds", "histogram", "Time spent handling HTTP requests, by route, method and status code.", LATENCY_BUCKETS)
+registry.define("downstream_request_duration_seconds", "histogram", "Time spent on calls to other services, by downstream service, path and status code.", LATENCY_BUCKETS)
+registry.define("sqlite_query_duration_seconds", "histogram", "Time spent in SQLite, by database, statement and phase (execute or fetch).", QUERY_BUCKETS)
+
+def observe_downstream(downstream, method, path, status, seconds):
+	registry.observe("downstream_request_duration_seconds",
+		(("downstream", downstream), ("method", method), ("path", path), ("status", status)), seconds)
+
+@lru_cache(maxsize=4096)
+def query_labels(database, sql, phase):
+	return (("database", database), ("statement", normalize_sql(sql)), ("phase", phase))
+
+def observe_query(database, sql, phase, seconds):
+	registry.observe("sqlite_query_duration_seconds", query_labels(database, sql, phase), seconds)
+
+def instrument(app, service):
+	@app.before_request
+	def start_request_timer():
+		g.metrics_start = time.perf_counter()
+		registry.ensure_writer()
+
+	@app.after_request
+	def record_request(response):
+		start = g.pop("metrics_start", None)
+		if start is not None:
+			route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+			labels = (("service", service), ("route", route), ("method", request.method), ("status", str(response.status_code)))
+			registry.inc("http_requests_total", labels)
+			registry.observe("http_request_duration_seconds", labels, time.perf_counter() - start)
+		return response
+
+	@app.route('/metrics', methods=['GET'])
+	def metrics():
+		return Response(registry.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,151 @@
+"""
+Protection against slow, failing or overloaded services.
+Every call made through common.client passes the Guard of its downstream service, which combines
+- a bulkhead: at most <SERVICE>_MAX_IN_FLIGHT calls (default RESILIENCE_MAX_IN_FLIGHT) to that service
+  are in flight per process; a call waits up to BULKHEAD_WAIT seconds for a slot and is then refused,
+  so a stalled service ties up a bounded number of threads instead of all of them, and
+- a circuit breaker: after BREAKER_FAILURES consecutive failures (errors, timeouts and 5xx answers) it
+  opens and refuses every call for BREAKER_OPEN_SECONDS, then lets a single probe call through
+  (half open); the probe closes it again if it succeeds and reopens it if it fails.
+A refused call raises Unavailable without touching the network; so does, after the fact, a call that
+failed or was answered with a 5xx (see common.client).
+instrument(app, service) sheds load at ingress, answering 503 at once to
+- a request that waited more than INGRESS_MAX_QUEUE_WAIT seconds before a thread picked it up, as
+  told by its X-Request-Start header (set by common.gunicorn_worker, or by a load balancer); a
+  gthread worker never runs more requests than it has threads, so the excess queues there instead,
+- a request beyond INGRESS_MAX_IN_FLIGHT handled at once by the process, which only limits servers
+  that start a thread per request, such as the Flask development server, and
+- a request whose downstream call was refused.
+Refusals, breaker transitions and shed requests are counted in common.metrics.
+"""
+
+import json
+import os
+import threading
+import time
+from flask import g, request
+from common import metrics
+
+MAX_IN_FLIGHT = int(os.environ.get("RESILIENCE_MAX_IN_FLIGHT", "64"))
+BULKHEAD_WAIT = float(os.environ.get("BULKHEAD_WAIT", "0.5"))
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "5"))
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", "5"))
+INGRESS_MAX_IN_FLIGHT = int(os.environ.get("INGRESS_MAX_IN_FLIGHT", "128"))
+INGRESS_MAX_QUEUE_WAIT = float(os.environ.get("INGRESS_MAX_QUEUE_WAIT", "1"))
+
+# Routes that are never shed, so health checks and scrapes still answer under load.
+UNSHED_ROUTES = ("/ready", "/metrics")
+
+metrics.registry.define("downstream_rejected_total", "counter", "Calls to other services refused without being sent, by downstream service and reason (bulkhead or circuit_open).")
+metrics.registry.define("circuit_breaker_transitions_total", "counter", "Circuit breaker state changes, by downstream service and new state (open, half_open or closed).")
+metrics.registry.define("http_requests_shed_total", "counter", "Requests answered with 503 without being handled, by service and reason (queue_wait, overload or downstream).")
+
+class Unavailable(Exception):
+	# Raised instead of calling a downstream service that is failing or has no free slot, and by
+	# common.client when a call fails or is answered with a 5xx.
+	def __init__(self, downstream, reason):
+		super().__init__(f"{downstream} unavailable: {reason}")
+		self.downstream = downstream
+		self.reason = reason
+
+class Guard:
+	def __init__(self, downstream, max_in_flight=None):
+		self.downstream = downstream
+		if max_in_flight is None:
+			max_in_flight = int(os.environ.get(f"{downstream.upper()}_MAX_IN_FLIGHT", MAX_IN_FLIGHT))
+		self._slots = threading.BoundedSemaphore(max_in_flight)
+		self._lock = threading.Lock()
+		self._state = "closed"
+		self._failures = 0
+		self._opened_at = 0.0
+		self._probing = False
+
+	def acquire(self):
+		# Takes a slot for one call and returns whether it is the half open probe.
+		# Raises Unavailable if the breaker is open or no slot frees up in time.
+		probe = False
+		with self._lock:
+			if self._state == "open" and time.monotonic() - self._opened_at >= BREAKER_OPEN_SECONDS:
+				self._transition("half_open")
+			if self._state == "open" or (self._state == "half_open" and self._probing):
+				self._reject("circuit_open")
+			if self._state == "half_open":
+				self._probing = probe = True
+		if not self._slots.acquire(timeout=BULKHEAD_WAIT):
+			if probe:
+				with self._lock:
+					self._probing = False
+			self._reject("bulkhead")
+		return probe
+
+	def release(self, ok, probe):
+		# Frees the slot and records the outcome of the call.
+		self._slots.release()
+		with self._lock:
+			if probe:
+				self._probing = False
+			if ok:
+				self._failures = 0
+				if probe:
+					self._transition("closed")
+			else:
+				self._failures += 1
+				if probe or (self._state == "closed" and self._failures >= BREAKER_FAILURES):
+					self._opened_at = time.monotonic()
+					self._transition("open")
+
+	def _transition(self, state):
+		self._state = state
+		metrics.registry.inc("circuit_breaker_transitions_total", (("downstream", self.downstream), ("state", state)))
+
+	def _reject(self, reason):
+		metrics.registry.inc("downstream_rejected_total", (("downstream", self.downstream), ("reason", reason)))
+		raise Unavailable(self.downstream, reason)
+
+def queue_wait():
+	# Seconds since the X-Request-Start time of the current request, or None without one.
+	# The value is t=<time> in seconds, milliseconds or microseconds since the epoch.
+	value = request.headers.get("X-Request-Start", "")
+	try:
+		started = float(value[2:] if value.startswith("t=") else value)
+	except ValueError:
+		return None
+	if started > 1e14:
+		started /= 1e6
+	elif started > 1e11:
+		started /= 1e3
+	return time.time() - started
+
+def instrument(app, service):
+	def overloaded(reason):
+		metrics.registry.inc("http_requests_shed_total", (("service", service), ("reason", reason)))
+		return json.dumps({"status": 2}), 503, {"Retry-After": "1"}
+
+	in_flight = 0
+	in_flight_lock = threading.Lock()
+
+	@app.before_request
+	def shed_load():
+		nonlocal in_flight
+		if request.path in UNSHED_ROUTES:
+			return None
+		waited = queue_wait()
+		if waited is not None and waited > INGRESS_MAX_QUEUE_WAIT:
+			return overloaded("queue_wait")
+		with in_flight_lock:
+			if in_flight >= INGRESS_MAX_IN_FLIGHT:
+				return overloaded("overload")
+			in_flight += 1
+		g.resilience_admitted = True
+		return None
+
+	@app.teardown_request
+	def leave(exception):
+		nonlocal in_flight
+		if g.pop("resilience_admitted", False):
+			with in_flight_lock:
+				in_flight -= 1
+
+	@app.errorhandler(Unavailable)
+	def downstream_unavailable(error):
+		return overloaded("downstream")
@@ -0,0 +1,7 @@
+#!/bin/sh
+# Starts the service in this directory. SERVER_MODE=development uses the single process Flask
+# development server, anything else runs gunicorn with several worker processes and threads.
+if [ "$SERVER_MODE" = "development" ]; then
+	exec flask run --host=0.0.0.0
+fi
+exec gunicorn --config common/gunicorn.conf.py app:app
@@ -0,0 +1,44 @@
+"""
+Named database snapshots, so a test or staging harness can seed a service once and then return to
+that state in one call instead of clearing and seeding it again.
+instrument(app, database, after_restore) adds
+POST /snapshots/<name>, which saves the service database as snapshot `name`,
+POST /snapshots/<name>/restore, which replaces the database with it and calls after_restore(name)
+so the service can drop what it cached from the old data, and
+GET /snapshots, which lists the saved snapshots.
+The copies are made with the SQLite backup API by common.db.Database.
+"""
+
+import contextlib
+import json
+
+def instrument(app, database, after_restore=None, after_save=None, lock=None):
+	# lock: returns a context manager held around a save or restore and its hook, for services
+	# whose data is not all in the database.
+	lock = lock or contextlib.nullcontext
+
+	@app.route('/snapshots', methods=['GET'])
+	def list_snapshots():
+		return json.dumps({"status": 1, "snapshots": database.snapshots()})
+
+	@app.route('/snapshots/<name>', methods=['POST'])
+	def save_snapshot(name):
+		try:
+			with lock():
+				database.save_snapshot(name)
+				if after_save:
+					after_save(name)
+		except ValueError:
+			return json.dumps({"status": 2})
+		return json.dumps({"status": 1})
+
+	@app.route('/snapshots/<name>/restore', methods=['POST'])
+	def restore_snapshot(name):
+		try:
+			with lock():
+				database.restore_snapshot(name)
+				if after_restore:
+					after_restore(name)
+		except (ValueError, KeyError):
+			return json.dumps({"status": 2})
+		return json.dumps({"status": 1})
@@ -0,0 +1,111 @@
+"""
+Keyset pagination and NDJSON streaming for endpoints that return table rows.
+Rows are read in pages of `row_id > after ORDER BY row_id LIMIT n`, so a client can resume from the
+last row_id it saw, and a streamed response only ever holds one page in memory.
+"""
+
+import csv
+import io
+import json
+import sqlite3
+from flask import Response, request, stream_with_context
+
+# Rows fetched per query while streaming.
+STREAM_PAGE_SIZE = 500
+# Page size for paginated JSON responses when only `after` is given, and the largest allowed.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def requested(args):
+	# Pagination and streaming are opt in, so existing callers keep the original response.
+	return any(key in args for key in ("after", "limit", "format"))
+
+def wants_ndjson(args):
+	return args.get("format") == "ndjson"
+
+def pagination_args(args):
+	# Returns (after, limit). limit is None for an unbounded stream. Raises ValueError on bad input.
+	after = int(args.get("after", 0))
+	limit = args.get("limit")
+	if limit is None:
+		limit = None if wants_ndjson(args) else DEFAULT_PAGE_SIZE
+	else:
+		limit = int(limit)
+		if limit < 1:
+			raise ValueError("limit must be positive")
+		if not wants_ndjson(args):
+			limit = min(limit, MAX_PAGE_SIZE)
+	return after, limit
+
+def keyset_rows(conn, query, params, after, limit):
+	# Yields rows as dictionaries. `query` must end with "row_id > ? ORDER BY row_id LIMIT ?"
+	# (row_id may be an alias) and select a row_id column; `params` fill the placeholders before those two.
+	remaining = limit
+	while remaining is None or remaining > 0:
+		page_size = STREAM_PAGE_SIZE if remaining is None else min(STREAM_PAGE_SIZE, remaining)
+		cursor = conn.cursor()
+		cursor.row_factory = sqlite3.Row
+		cursor.execute(query, tuple(params) + (after, page_size))
+		rows = cursor.fetchall()
+		for row in rows:
+			yield dict(row)
+		if len(rows) < page_size:
+			return
+		after = rows[-1]["row_id"]
+		if remaining is not None:
+			remaining -= len(rows)
+
+def import_records():
+	# Yields one dictionary per record of the request body, which is CSV with a header row
+	# (Content-Type: text/csv) or NDJSON. Records that cannot be parsed, or that are not valid
+	# UTF-8, are yielded as None.
+	body = io.TextIOWrapper(request.stream, encoding='utf-8', errors='surrogateescape', newline='')
+	if request.mimetype == 'text/csv':
+		reader = csv.DictReader(body)
+		while True:
+			try:
+				record = next(reader)
+			except StopIteration:
+				return
+			except csv.Error:
+				record = None
+			yield record if decoded(record) else None
+	for line in body:
+		if not line.strip():
+			continue
+		try:
+			record = json.loads(line)
+		except Exception:
+			record = None
+		yield record if isinstance(record, dict) and decoded(record) else None
+
+def decoded(record):
+	# False if the record holds bytes that were not valid UTF-8 (kept as surrogates when read).
+	try:
+		json.dumps(record, ensure_ascii=False).encode('utf-8')
+	except UnicodeEncodeError:
+		return False
+	return True
+
+def chunks(records, size):
+	# Groups an iterator into lists of at most `size` items, reading it lazily.
+	chunk = []
+	for record in records:
+		chunk.append(record)
+		if len(chunk) == size:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+def ndjson_response(objects):
+	lines = (json.dumps(obj) + "\n" for obj in objects)
+	return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+
+def page_response(rows, limit, key=None):
+	# Paginated JSON: the rows (keyed by row_id when `key` is set) and the cursor for the next page,
+	# or "NULL" once the last page has been returned.
+	rows = list(rows)
+	next_after = rows[-1]["row_id"] if len(rows) == limit else "NULL"
+	data = {row["row_id"]: key(row) for row in rows} if key else rows
+	return json.dumps({"status": 1, "data": data, "next_after": next_after})
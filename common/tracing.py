@@ -0,0 +1,171 @@
+"""
+Request IDs and span timing across the microservices.
+instrument(app, service) accepts the caller's X-Request-ID (or generates one), returns it in the response
+and records a server span for every request. common.client forwards the ID and the calling span on every
+outbound call and records a client span for it, so the spans of all services can be stitched into one trace.
+Spans are kept in an in-memory ring buffer of TRACE_BUFFER_SIZE spans. When TRACE_DIR is set (gunicorn does
+this), each worker also appends its spans to a file there, so any worker can answer for the whole service.
+GET /trace/<request_id> returns the spans one service recorded for a request; with federate=1 it also asks
+every other service and returns the whole trace, ordered by start time.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from flask import g, request
+
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", "10000"))
+TRACE_DIR = os.environ.get("TRACE_DIR")
+SYNC_INTERVAL = float(os.environ.get("TRACE_SYNC_INTERVAL", "1"))
+
+REQUEST_ID_HEADER = "X-Request-ID"
+PARENT_SPAN_HEADER = "X-Parent-Span-ID"
+REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9._:-]{1,128}")
+
+# (request_id, span_id, service) of the request being handled, or None outside a request.
+current = ContextVar("trace_context", default=None)
+
+class SpanStore:
+	def __init__(self, size):
+		self._spans = deque(maxlen=size)
+		self._pending = []
+		self._lines = 0
+		self._lock = threading.Lock()
+		self._thread = None
+		self._pid = None
+
+	def add(self, span):
+		with self._lock:
+			self._spans.append(span)
+			if TRACE_DIR:
+				self._pending.append(span)
+		self._ensure_writer()
+
+	def find(self, request_id):
+		with self._lock:
+			spans = [span for span in self._spans if span["request_id"] == request_id]
+		if TRACE_DIR and os.path.isdir(TRACE_DIR):
+			own = f"{os.getpid()}.spans"
+			for entry in os.listdir(TRACE_DIR):
+				if entry.startswith(own) or ".spans" not in entry:
+					continue
+				try:
+					with open(os.path.join(TRACE_DIR, entry)) as span_file:
+						spans.extend(json.loads(line) for line in span_file if request_id in line)
+				except (OSError, ValueError):
+					continue
+		return [span for span in spans if span["request_id"] == request_id]
+
+	def _ensure_writer(self):
+		# Started lazily so that forked worker processes each write their own file.
+		if TRACE_DIR and (self._thread is None or self._pid != os.getpid()):
+			with self._lock:
+				if self._thread is not None and self._pid == os.getpid():
+					return
+				self._pid = os.getpid()
+				self._pending = []
+				self._lines = 0
+				self._thread = threading.Thread(target=self._run_writer, name="trace-writer", daemon=True)
+				self._thread.start()
+
+	def _run_writer(self):
+		while True:
+			time.sleep(SYNC_INTERVAL)
+			with self._lock:
+				pending, self._pending = self._pending, []
+			if pending:
+				try:
+					self._append(pending)
+				except OSError:
+					pass
+
+	def _append(self, spans):
+		# The file is rotated once it holds a buffer's worth of spans, so each worker keeps
+		# between one and two buffers of history on disk.
+		os.makedirs(TRACE_DIR, exist_ok=True)
+		path = os.path.join(TRACE_DIR, f"{os.getpid()}.spans")
+		if self._lines >= TRACE_BUFFER_SIZE:
+			os.replace(path, path + ".1")
+			self._lines = 0
+		with open(path, "a") as span_file:
+			span_file.write("".join(json.dumps(span) + "\n" for span in spans))
+		self._lines += len(spans)
+
+store = SpanStore(TRACE_BUFFER_SIZE)
+
+def new_span_id():
+	return os.urandom(8).hex()
+
+def record(kind, name, span_id, parent_id, start, duration, status):
+	context = current.get()
+	store.add({
+		"request_id": context[0],
+		"span_id": span_id,
+		"parent_id": parent_id,
+		"service": context[2],
+		"kind": kind,
+		"name": name,
+		"start": start,
+		"duration_ms": round(duration * 1000, 3),
+		"status": status,
+	})
+
+def outbound_headers():
+	# Headers for a call made on behalf of the current request, and the id of the client span
+	# it will be recorded as. Calls made outside a request (background threads) are not traced.
+	context = current.get()
+	if context is None:
+		return None, {}
+	span_id = new_span_id()
+	return span_id, {REQUEST_ID_HEADER: context[0], PARENT_SPAN_HEADER: span_id}
+
+def record_call(span_id, downstream, method, path, status, start, duration):
+	if span_id is not None:
+		record("client", f"{method} {downstream} {path}", span_id, current.get()[1], start, duration, status)
+
+def instrument(app, service):
+	@app.before_request
+	def start_span():
+		request_id = request.headers.get(REQUEST_ID_HEADER, "")
+		if not REQUEST_ID_PATTERN.fullmatch(request_id):
+			request_id = uuid.uuid4().hex
+		g.trace_token = current.set((request_id, new_span_id(), service))
+		g.trace_parent = request.headers.get(PARENT_SPAN_HEADER)
+		g.trace_start = (time.time(), time.perf_counter())
+
+	@app.after_request
+	def finish_span(response):
+		context = current.get()
+		if context is not None and "trace_start" in g:
+			start, started = g.pop("trace_start")
+			route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+			record("server", f"{request.method} {route}", context[1], g.trace_parent, start, time.perf_counter() - started, str(response.status_code))
+			response.headers[REQUEST_ID_HEADER] = context[0]
+		return response
+
+	@app.teardown_request
+	def end_context(exception):
+		token = g.pop("trace_token", None)
+		if token is not None:
+			current.reset(token)
+
+	@app.route('/trace/<request_id>', methods=['GET'])
+	def trace(request_id):
+		spans = store.find(request_id)
+		if request.args.get("federate") == "1":
+			# Imported here because common.client itself uses this module.
+			from common import client
+			for downstream in client.services():
+				if downstream.name == service:
+					continue
+				try:
+					spans.extend(downstream.trace(request_id)["spans"])
+				except Exception:
+					continue
+		spans.sort(key=lambda span: span["start"])
+		return json.dumps({"status": 1, "request_id": request_id, "spans": spans})
@@ -1,6 +1,6 @@
 """
 This microservice handles logging functionality for user actions.
-It uses a SQLite database to store logs.
+It uses a SQLite database to store recent logs, and compressed segment files to archive older ones.
 Port 9004
 """
 
@@ -12,53 +12,280 @@ import hashlib
 import re
 import base64
 import hmac
-import requests
+import fcntl
+import gzip
+import heapq
+import io
+import math
+import shutil
+import threading
+import time
+from common import codec, jwt_verifier, metrics, resilience, snapshots, streaming, tracing
+from common.db import Database
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
 
 app = Flask(__name__)
+metrics.instrument(app, "logs")
+tracing.instrument(app, "logs")
+codec.instrument(app)
+resilience.instrument(app, "logs")
 db_name = "logs.db"
-sql_file = "logs.sql"
-db_flag = False
+sql_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs.sql")
+database = Database(db_name, sql_file, reseed="UPDATE feed_state SET epoch = lower(hex(randomblob(8)));")
 
-def create_db():
-	conn = sqlite3.connect(db_name)
-	with open(sql_file, 'r') as sql_startup:
-		init_db = sql_startup.read()
-	cursor = conn.cursor()
-	cursor.executescript(init_db)
-	conn.execute("PRAGMA foreign_keys = ON")
-	conn.commit()
-	conn.close()
-	global db_flag
-	db_flag = True
-	return conn
+# Maximum number of names bound into a single IN (...) query.
+BATCH_CHUNK_SIZE = 500
+
+# Default and maximum number of entries returned by one /last_mod/changes call.
+CHANGES_PAGE_SIZE = 1000
+
+# Rows older than LOG_RETENTION_SECONDS are moved out of the logs table every LOG_COMPACT_INTERVAL
+# seconds, into append-only compressed NDJSON segments in LOG_ARCHIVE_DIR, one segment per
+# LOG_SEGMENT_SECONDS time range and compaction run. view_log reads the archive and the table together.
+# Segments are zstd compressed when the zstandard package is installed, gzip compressed otherwise.
+RETENTION_SECONDS = float(os.environ.get("LOG_RETENTION_SECONDS", "604800"))
+COMPACT_INTERVAL = float(os.environ.get("LOG_COMPACT_INTERVAL", "60"))
+SEGMENT_SECONDS = int(os.environ.get("LOG_SEGMENT_SECONDS", "3600"))
+# Rows moved per compaction transaction.
+COMPACT_BATCH_SIZE = int(os.environ.get("LOG_COMPACT_BATCH_SIZE", "50000"))
+archive_dir = os.environ.get("LOG_ARCHIVE_DIR", "logs_archive")
+SEGMENT_SUFFIX = ".ndjson.zst" if zstandard else ".ndjson.gz"
+
+# Rollup periods and their length in seconds; logs.sql fills log_rollups with the same ones.
+ROLLUP_PERIODS = {"hour": 3600, "day": 86400}
+ROLLUP_DIMENSIONS = ("user", "product")
+# Default and maximum number of keys returned by /rollups/top.
+ROLLUP_TOP_K = 10
+ROLLUP_MAX_K = 1000
+# Largest number of buckets one /rollups/series call may return.
+ROLLUP_MAX_BUCKETS = 10000
+# Default time range of a rollup query, counted back from now, in periods.
+ROLLUP_DEFAULT_BUCKETS = {"hour": 24, "day": 30}
+# since and until must lie within this many seconds of the epoch, so every bucket computed from
+# them is an integer SQLite can bind.
+ROLLUP_MAX_TIME = 2 ** 53
+
+compactor_lock = threading.Lock()
+compactor = None
+compactor_pid = None
+
+def create_db(reset=False):
+	# Idempotent: creates the schema once, or drops and recreates it with reset=True.
+	database.init_schema(reset)
 
 def get_db():
-	if not db_flag:
-		create_db()
-	conn = sqlite3.connect(db_name)
-	return conn
+	return database.get()
+
+create_db()
+
+@app.teardown_appcontext
+def release_db(exception):
+	database.release()
 
 @app.route('/', methods=(['GET']))
 def index():
+	if streaming.requested(request.args):
+		try:
+			after, limit = streaming.pagination_args(request.args)
+		except ValueError:
+			return json.dumps({"status": 2, "data": "NULL"})
+		rows = streaming.keyset_rows(get_db(), "SELECT row_id, event, username, name FROM logs WHERE row_id > ? ORDER BY row_id LIMIT ?", (), after, limit)
+		if streaming.wants_ndjson(request.args):
+			return streaming.ndjson_response(rows)
+		return streaming.page_response(rows, limit)
+
 	conn = get_db()
 	cursor = conn.cursor()
-	cursor.execute("SELECT * FROM logs;")
+	cursor.execute("SELECT row_id, event, username, name FROM logs;")
 	result = cursor.fetchall()
-	conn.close()
 
 	return result
 
+@app.route('/ready', methods=['GET'])
+def ready():
+	if not database.ready():
+		return json.dumps({"status": 2}), 503
+	return json.dumps({"status": 1})
+
 @app.route('/clear', methods=['GET'])
 def clear():
-	if os.path.exists(db_name):
-		try:
-			os.remove(db_name)
-		except Exception as e:
-			return f"Error clearing database: {e}"
-	global db_flag
-	db_flag = False
+	# Under the compaction lock, so no segment is written for the database being dropped.
+	with compaction_lock():
+		create_db(reset=True)
+		shutil.rmtree(archive_dir, ignore_errors=True)
+	jwt_verifier.clear_cache()
 	return "Database Cleared"
 
+def save_archive(name):
+	# Archived rows are part of the log, so a snapshot keeps a copy of the segments next to the database.
+	copy = os.path.join(database.snapshot_dir, name + ".archive")
+	shutil.rmtree(copy, ignore_errors=True)
+	if os.path.isdir(archive_dir):
+		shutil.copytree(archive_dir, copy)
+
+def restore_archive(name):
+	copy = os.path.join(database.snapshot_dir, name + ".archive")
+	shutil.rmtree(archive_dir, ignore_errors=True)
+	if os.path.isdir(copy):
+		shutil.copytree(copy, archive_dir)
+	jwt_verifier.clear_cache()
+
+class compaction_lock:
+	# Exclusive lock on "<database>.compact.lock", shared by every worker process.
+	# With blocking=False, entering returns False instead of waiting when another process holds it.
+	def __init__(self, blocking=True):
+		self.blocking = blocking
+
+	def __enter__(self):
+		self.file = open(db_name + ".compact.lock", "a")
+		try:
+			fcntl.flock(self.file, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			return False
+		return True
+
+	def __exit__(self, *exc_info):
+		self.file.close()
+
+# Under the compaction lock, so the database and the archive are saved and restored together.
+snapshots.instrument(app, database, restore_archive, save_archive, compaction_lock)
+
+def write_segment(file_name, rows):
+	# Written under a temporary name and then renamed, so a segment file is either complete or absent.
+	os.makedirs(archive_dir, exist_ok=True)
+	path = os.path.join(archive_dir, file_name)
+	data = "".join(json.dumps(row) + "\n" for row in rows).encode()
+	if file_name.endswith(".zst"):
+		data = zstandard.ZstdCompressor().compress(data)
+	else:
+		data = gzip.compress(data)
+	with open(path + ".tmp", "wb") as segment_file:
+		segment_file.write(data)
+		segment_file.flush()
+		os.fsync(segment_file.fileno())
+	os.replace(path + ".tmp", path)
+
+def read_segment(file_name):
+	# Yields the rows of a segment, decompressing it as it goes.
+	path = os.path.join(archive_dir, file_name)
+	if file_name.endswith(".zst"):
+		with open(path, "rb") as raw:
+			for line in io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(raw)):
+				yield json.loads(line)
+	else:
+		with gzip.open(path, "rt") as segment_file:
+			for line in segment_file:
+				yield json.loads(line)
+
+def compact(older_than=RETENTION_SECONDS, blocking=True):
+	# Moves the rows logged more than `older_than` seconds ago into new segments and returns
+	# (rows archived, segments written), or None if another process is already compacting.
+	# Rows are taken from the start of the table, in row_id order, up to the first newer row.
+	with compaction_lock(blocking) as locked:
+		if not locked:
+			return None
+
+		cutoff = time.time() - older_than
+		conn = get_db()
+		cursor = conn.cursor()
+		archived = segments = 0
+		while True:
+			cursor.execute("SELECT row_id, event, username, name, created_at FROM logs ORDER BY row_id LIMIT ?", (COMPACT_BATCH_SIZE,))
+			batch = cursor.fetchall()
+			rows = []
+			for row in batch:
+				if row[4] >= cutoff:
+					break
+				rows.append(row)
+			if not rows:
+				break
+
+			buckets = {}
+			for row in rows:
+				buckets.setdefault(int(row[4] // SEGMENT_SECONDS) * SEGMENT_SECONDS, []).append(row)
+
+			# The files are written first; the index and the deletion then commit in one short transaction.
+			written = []
+			try:
+				for start, bucket in sorted(buckets.items()):
+					file_name = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime(start))}-{bucket[0][0]}-{bucket[-1][0]}{SEGMENT_SUFFIX}"
+					write_segment(file_name, [{"row_id": row[0], "event": row[1], "user": row[2], "name": row[3], "created_at": row[4]} for row in bucket])
+					written.append(file_name)
+					cursor.execute(
+						"""INSERT INTO log_segments (file_name, first_row_id, last_row_id, first_created_at, last_created_at, row_count)
+						VALUES (?, ?, ?, ?, ?, ?)""",
+						(file_name, bucket[0][0], bucket[-1][0], min(row[4] for row in bucket), max(row[4] for row in bucket), len(bucket))
+					)
+					segment_id = cursor.lastrowid
+					keys = {("username", row[2]) for row in bucket} | {("name", row[3]) for row in bucket if row[3] is not None}
+					cursor.executemany("INSERT INTO log_segment_keys (kind, value, segment_id) VALUES (?, ?, ?)", [(kind, value, segment_id) for kind, value in keys])
+				cursor.executemany("DELETE FROM logs WHERE row_id = ?", [(row[0],) for row in rows])
+				conn.commit()
+			except Exception:
+				if conn.in_transaction:
+					conn.rollback()
+				for file_name in written:
+					try:
+						os.remove(os.path.join(archive_dir, file_name))
+					except OSError:
+						pass
+				raise
+
+			archived += len(rows)
+			segments += len(buckets)
+			if len(rows) < len(batch) or len(batch) < COMPACT_BATCH_SIZE:
+				break
+		return archived, segments
+
+def run_compactor():
+	while True:
+		time.sleep(COMPACT_INTERVAL)
+		try:
+			compact(blocking=False)
+		except Exception:
+			pass
+
+@app.before_request
+def start_compactor():
+	# Started lazily so that every worker process runs one; the file lock lets one compact at a time.
+	global compactor, compactor_pid
+	if COMPACT_INTERVAL > 0 and (compactor is None or compactor_pid != os.getpid()):
+		with compactor_lock:
+			if compactor is None or compactor_pid != os.getpid():
+				compactor_pid = os.getpid()
+				compactor = threading.Thread(target=run_compactor, name="log-compactor", daemon=True)
+				compactor.start()
+
+def employee_access(jwt_token):
+	# Rollups and compaction cover every user and product, so they are for employees only like
+	# product logs. Returns the status to answer with, or None if the caller may use them.
+	user_data = jwt_verifier.verify(jwt_token)
+	if user_data["status"] == 2:
+		return 2
+	if user_data.get("employee") != "True":
+		return 3
+	return None
+
+@app.route('/compact', methods=['POST'])
+def compact_now():
+	# Runs a compaction now. older_than (seconds) overrides LOG_RETENTION_SECONDS.
+	status = employee_access(request.headers.get('Authorization'))
+	if status:
+		return json.dumps({"status": status})
+	try:
+		older_than = float(request.form.get('older_than', RETENTION_SECONDS))
+	except ValueError:
+		return json.dumps({"status": 3})
+	if not math.isfinite(older_than) or older_than < 0:
+		return json.dumps({"status": 3})
+
+	archived, segments = compact(older_than)
+	return json.dumps({"status": 1, "archived": archived, "segments": segments})
+
 @app.route('/log', methods=['POST'])
 def log():
 	event = request.form.get('event')
@@ -69,10 +296,106 @@ def log():
 	cursor = conn.cursor()
 	cursor.execute("INSERT INTO logs (event, username, name) VALUES (?, ?, ?)", (event, username, name))
 	conn.commit()
-	conn.close()
 
 	return json.dumps({"status": 1})
 
+@app.route('/log/batch', methods=['POST'])
+def log_batch():
+	# The events are sent as a JSON encoded list of {"event", "user", "name"} objects by the log shipper.
+	events_raw = request.form.get('events')
+	if not events_raw:
+		return json.dumps({"status": 2})
+
+	try:
+		events = json.loads(events_raw)
+	except ValueError:
+		return json.dumps({"status": 2})
+	if not isinstance(events, list):
+		return json.dumps({"status": 2})
+
+	# Events without a string event and user (and a string or no name) are skipped and counted,
+	# since sending them again would not make them valid.
+	rows = [
+		(event["event"], event["user"], event.get("name")) for event in events
+		if isinstance(event, dict) and isinstance(event.get("event"), str) and isinstance(event.get("user"), str)
+		and isinstance(event.get("name"), (str, type(None)))
+	]
+
+	# Insert the whole batch in one transaction, keeping the order it was sent in.
+	conn = get_db()
+	cursor = conn.cursor()
+	cursor.executemany("INSERT INTO logs (event, username, name) VALUES (?, ?, ?)", rows)
+	conn.commit()
+
+	return json.dumps({"status": 1, "rejected": len(events) - len(rows)})
+
+def merge_sources(sources):
+	# Merges row iterators into one in row_id order. `sources` are (lowest row_id, function opening
+	# the iterator) pairs sorted by lowest row_id; a source is only opened once the merge reaches
+	# that row_id, so only segments that overlap are open at the same time.
+	heap = []
+	index = 0
+	while heap or index < len(sources):
+		while index < len(sources) and (not heap or sources[index][0] <= heap[0][0]):
+			rows = sources[index][1]()
+			row = next(rows, None)
+			if row is not None:
+				heapq.heappush(heap, (row["row_id"], index, row, rows))
+			index += 1
+		if not heap:
+			continue
+		_, source, row, rows = heapq.heappop(heap)
+		yield row
+		row = next(rows, None)
+		if row is not None:
+			heapq.heappush(heap, (row["row_id"], source, row, rows))
+
+def log_rows(column, value, after=0, limit=None):
+	# Yields the {row_id, event, user, name} rows where `column` ("username" or "name") equals `value`
+	# and row_id > after, in row_id order, from the archived segments and the logs table together.
+	# `column` is always one of the fixed names passed by view_logs.
+	conn = get_db()
+	if not conn.in_transaction:
+		# One read snapshot for the segment index and the table, so rows a concurrent compaction
+		# moves are seen in exactly one of them. The request teardown ends it.
+		conn.execute("BEGIN")
+	cursor = conn.cursor()
+	cursor.execute(
+		"""SELECT s.first_row_id, s.file_name FROM log_segment_keys k JOIN log_segments s ON s.segment_id = k.segment_id
+		WHERE k.kind = ? AND k.value = ? AND s.last_row_id > ? ORDER BY s.first_row_id""",
+		(column, value, after)
+	)
+	field = "user" if column == "username" else "name"
+
+	def archived(file_name):
+		return (row for row in read_segment(file_name) if row[field] == value and row["row_id"] > after)
+
+	def hot():
+		return streaming.keyset_rows(
+			conn,
+			f"SELECT row_id, event, username AS user, name FROM logs WHERE {column}=? AND row_id > ? ORDER BY row_id LIMIT ?",
+			(value,), after, limit
+		)
+
+	sources = [(after, hot)] + [(first_row_id, lambda file_name=file_name: archived(file_name)) for first_row_id, file_name in cursor.fetchall()]
+	for count, row in enumerate(merge_sources(sources)):
+		if limit is not None and count >= limit:
+			return
+		yield {"row_id": row["row_id"], "event": row["event"], "user": row["user"], "name": row["name"]}
+
+def paged_logs(column, value):
+	# Keyset paginated (after, limit) or NDJSON streamed (format=ndjson) view of the logs where
+	# `column` equals `value`.
+	try:
+		after, limit = streaming.pagination_args(request.args)
+	except ValueError:
+		return json.dumps({"status": 3, "data": "NULL"})
+
+	rows = log_rows(column, value, after, limit)
+	if streaming.wants_ndjson(request.args):
+		return streaming.ndjson_response(rows)
+	return streaming.page_response(rows, limit, key=lambda row: {'event': row['event'], 'user': row['user'], 'name': row['name']})
+
 @app.route('/view_log', methods=['GET'])
 def view_logs():
 	username = request.args.get('username')
@@ -80,10 +403,7 @@ def view_logs():
 	jwt_token = request.headers.get('Authorization')
 
 	# Verify the user.
-	URL = "http://user:5000/verify"
-	PARAMS = {'jwt': jwt_token}
-	r = requests.get(url=URL, params=PARAMS)
-	user_data = r.json()
+	user_data = jwt_verifier.verify(jwt_token)
 
 	# If the JWT is not valid, return NULL.
 	if user_data["status"] == 2:
@@ -94,18 +414,17 @@ def view_logs():
 		if (user_data["user"] != username):
 			return json.dumps({"status": 3, "data": "NULL"})
 
-		conn = get_db()
-		cursor = conn.cursor()
-		cursor.execute("SELECT event, username, name FROM logs WHERE username=? ORDER BY row_id", (username,))
-		logs = cursor.fetchall()
-		conn.close()
+		if streaming.requested(request.args):
+			return paged_logs("username", username)
+
+		logs = list(log_rows("username", username))
 
 		logs_list = {}
 		for i in range(1, len(logs)+1):
 			logs_list[i] = {
-				'event': logs[i-1][0],
-				'user': logs[i-1][1],
-				'name': logs[i-1][2],
+				'event': logs[i-1]['event'],
+				'user': logs[i-1]['user'],
+				'name': logs[i-1]['name'],
 			}
 
 		ret_list = {"status": 1, "data": logs_list}
@@ -115,19 +434,18 @@ def view_logs():
 		# If the user is not an employee and requesting logs for a product, return NULL.
 		if user_data.get("employee") != "True":
 			return json.dumps({"status": 3, "data": "NULL"})
+
+		if streaming.requested(request.args):
+			return paged_logs("name", product)
 		
-		conn = get_db()
-		cursor = conn.cursor()
-		cursor.execute("SELECT event, username, name FROM logs WHERE name=? ORDER BY row_id", (product,))
-		logs = cursor.fetchall()
-		conn.close()
+		logs = list(log_rows("name", product))
 
 		logs_list = {}
 		for i in range(1, len(logs)+1):
 			logs_list[i] = {
-				'event': logs[i-1][0],
-				'user': logs[i-1][1],
-				'name': logs[i-1][2],
+				'event': logs[i-1]['event'],
+				'user': logs[i-1]['user'],
+				'name': logs[i-1]['name'],
 			}
 
 		ret_list = {"status": 1, "data": logs_list}
@@ -141,12 +459,148 @@ def last_mod():
 
 	conn = get_db()
 	cursor = conn.cursor()
-	cursor.execute("SELECT username FROM logs WHERE name=? ORDER BY row_id DESC LIMIT 1", (product_name,))
+	cursor.execute("SELECT username FROM product_last_mod WHERE name=?", (product_name,))
 	logs = cursor.fetchone()
-	conn.close()
 	last_mod = logs[0] if logs else None
 
 	if last_mod:
 		return json.dumps({"status": 1, "last_mod": last_mod})
 	else:
-		return json.dumps({"status": 2, "last_mod": "NULL"})
\ No newline at end of file
+		return json.dumps({"status": 2, "last_mod": "NULL"})
+
+@app.route('/last_mod/batch', methods=['POST'])
+def last_mod_batch():
+	# The names are sent as a JSON encoded list, like the products batch lookup.
+	names_raw = request.form.get('product_names')
+	if not names_raw:
+		return codec.response({"status": 2, "last_mod": "NULL"})
+
+	try:
+		names = json.loads(names_raw)
+	except Exception:
+		return codec.response({"status": 2, "last_mod": "NULL"})
+
+	if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+		return codec.response({"status": 2, "last_mod": "NULL"})
+
+	# Read the latest modifier of every requested name from product_last_mod, one query per chunk.
+	names = list(dict.fromkeys(names))
+	conn = get_db()
+	cursor = conn.cursor()
+	last_mods = {}
+	for start in range(0, len(names), BATCH_CHUNK_SIZE):
+		chunk = names[start:start + BATCH_CHUNK_SIZE]
+		placeholders = ", ".join("?" for _ in chunk)
+		cursor.execute(f"SELECT name, username FROM product_last_mod WHERE name IN ({placeholders})", chunk)
+		last_mods.update(cursor.fetchall())
+
+	# Names without any log entry map to "NULL", matching the single lookup.
+	return codec.response({"status": 1, "last_mod": {name: last_mods.get(name) or "NULL" for name in names}})
+
+
+@app.route('/last_mod/changes', methods=['GET'])
+def last_mod_changes():
+	# Change feed over product_last_mod: every product whose last modifier changed after log row `since`.
+	try:
+		since = int(request.args.get('since', 0))
+		# At least one entry per page, so a client following "more" always makes progress.
+		limit = max(1, min(int(request.args.get('limit', CHANGES_PAGE_SIZE)), CHANGES_PAGE_SIZE))
+		if not 0 <= since < 2 ** 63:
+			raise ValueError("since out of range")
+	except ValueError:
+		return codec.response({"status": 2, "last_mod": "NULL"})
+
+	conn = get_db()
+	cursor = conn.cursor()
+	cursor.execute("SELECT epoch FROM feed_state")
+	epoch = cursor.fetchone()[0]
+	cursor.execute(
+		"SELECT name, username, row_id FROM product_last_mod WHERE row_id > ? ORDER BY row_id LIMIT ?",
+		(since, limit)
+	)
+	rows = cursor.fetchall()
+
+	last_mods = [{"product_name": row[0], "last_mod": row[1], "row_id": row[2]} for row in rows]
+	seq = rows[-1][2] if rows else since
+	return codec.response({"status": 1, "epoch": epoch, "seq": seq, "more": len(rows) == limit, "last_mod": last_mods})
+
+def rollup_bucket(value, seconds):
+	# Start of the bucket holding the unix time `value`. Raises ValueError unless it is a finite
+	# number within ROLLUP_MAX_TIME.
+	value = float(value)
+	if not math.isfinite(value) or abs(value) > ROLLUP_MAX_TIME:
+		raise ValueError("time out of range")
+	return int(value // seconds) * seconds
+
+def rollup_args(args):
+	# Returns (dimension, period, event, since, until) with since and until rounded down to buckets.
+	# event is None for all events. Raises ValueError on bad input.
+	dimension = args.get('dimension')
+	period = args.get('period', 'hour')
+	if dimension not in ROLLUP_DIMENSIONS or period not in ROLLUP_PERIODS:
+		raise ValueError("unknown dimension or period")
+	seconds = ROLLUP_PERIODS[period]
+	until = rollup_bucket(args.get('until', time.time()), seconds)
+	since = rollup_bucket(args.get('since', until - (ROLLUP_DEFAULT_BUCKETS[period] - 1) * seconds), seconds)
+	if since > until:
+		raise ValueError("since is after until")
+	return dimension, period, args.get('event'), since, until
+
+@app.route('/rollups/top', methods=['GET'])
+def rollups_top():
+	# The k users or products with the most events (of one kind, with `event`) between since and until.
+	status = employee_access(request.headers.get('Authorization'))
+	if status:
+		return json.dumps({"status": status, "top": "NULL"})
+	try:
+		dimension, period, event, since, until = rollup_args(request.args)
+		k = int(request.args.get('k', ROLLUP_TOP_K))
+		if k < 1:
+			raise ValueError("k must be positive")
+	except ValueError:
+		return json.dumps({"status": 3, "top": "NULL"})
+
+	query = "SELECT key, SUM(count) AS total FROM log_rollups WHERE dimension = ? AND period = ?"
+	params = [dimension, period]
+	if event is not None:
+		query += " AND event = ?"
+		params.append(event)
+	# +key keeps the planner on the primary key, which covers the bucket range, instead of the key index.
+	query += " AND bucket BETWEEN ? AND ? GROUP BY +key ORDER BY total DESC, key LIMIT ?"
+	params += [since, until, min(k, ROLLUP_MAX_K)]
+
+	cursor = get_db().cursor()
+	cursor.execute(query, params)
+	top = [{"key": key, "count": count} for key, count in cursor.fetchall()]
+	return json.dumps({"status": 1, "dimension": dimension, "period": period, "since": since, "until": until, "top": top})
+
+@app.route('/rollups/series', methods=['GET'])
+def rollups_series():
+	# Event counts of one user or product per bucket from since to until, with empty buckets as 0.
+	status = employee_access(request.headers.get('Authorization'))
+	if status:
+		return json.dumps({"status": status, "series": "NULL"})
+	key = request.args.get('key')
+	try:
+		dimension, period, event, since, until = rollup_args(request.args)
+		if not key:
+			raise ValueError("key is required")
+	except ValueError:
+		return json.dumps({"status": 3, "series": "NULL"})
+	seconds = ROLLUP_PERIODS[period]
+	if (until - since) // seconds + 1 > ROLLUP_MAX_BUCKETS:
+		return json.dumps({"status": 3, "series": "NULL"})
+
+	query = "SELECT bucket, SUM(count) FROM log_rollups INDEXED BY log_rollups_key WHERE dimension = ? AND key = ? AND period = ?"
+	params = [dimension, key, period]
+	if event is not None:
+		query += " AND event = ?"
+		params.append(event)
+	query += " AND bucket BETWEEN ? AND ? GROUP BY bucket"
+	params += [since, until]
+
+	cursor = get_db().cursor()
+	cursor.execute(query, params)
+	counts = dict(cursor.fetchall())
+	series = [{"bucket": bucket, "count": counts.get(bucket, 0)} for bucket in range(since, until + 1, seconds)]
+	return json.dumps({"status": 1, "dimension": dimension, "key": key, "period": period, "series": series})
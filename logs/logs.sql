@@ -1,8 +1,89 @@
 DROP TABLE IF EXISTS logs;
+DROP TABLE IF EXISTS product_last_mod;
+DROP TABLE IF EXISTS feed_state;
+DROP TABLE IF EXISTS log_segment_keys;
+DROP TABLE IF EXISTS log_segments;
+DROP TABLE IF EXISTS log_rollups;
 
 CREATE TABLE logs (
     row_id INTEGER PRIMARY KEY AUTOINCREMENT,
     event TEXT NOT NULL,
     username TEXT NOT NULL,
-    name TEXT
-);
\ No newline at end of file
+    name TEXT,
+    -- Unix time the row was logged, used to move old rows into the archive.
+    created_at REAL NOT NULL DEFAULT ((julianday('now') - 2440587.5) * 86400.0)
+);
+
+CREATE INDEX logs_username ON logs (username);
+CREATE INDEX logs_name ON logs (name, row_id);
+
+-- Latest log row per product name, kept up to date by the trigger below.
+CREATE TABLE product_last_mod (
+    name TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    row_id INTEGER NOT NULL
+);
+
+CREATE INDEX product_last_mod_row_id ON product_last_mod (row_id);
+
+-- Identifies this copy of the log so replicas of product_last_mod notice when it is recreated.
+CREATE TABLE feed_state (
+    epoch TEXT NOT NULL
+);
+
+INSERT INTO feed_state (epoch) VALUES (lower(hex(randomblob(8))));
+
+CREATE TRIGGER logs_last_mod AFTER INSERT ON logs
+WHEN NEW.name IS NOT NULL
+BEGIN
+    INSERT INTO product_last_mod (name, username, row_id) VALUES (NEW.name, NEW.username, NEW.row_id)
+    ON CONFLICT (name) DO UPDATE SET username = excluded.username, row_id = excluded.row_id;
+END;
+
+-- Compressed NDJSON files in the archive directory, each holding log rows of one time range
+-- that compaction moved out of the logs table.
+CREATE TABLE log_segments (
+    segment_id INTEGER PRIMARY KEY,
+    file_name TEXT NOT NULL UNIQUE,
+    first_row_id INTEGER NOT NULL,
+    last_row_id INTEGER NOT NULL,
+    first_created_at REAL NOT NULL,
+    last_created_at REAL NOT NULL,
+    row_count INTEGER NOT NULL
+);
+
+-- The usernames and product names found in each segment, so a query only opens the segments it needs.
+CREATE TABLE log_segment_keys (
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    segment_id INTEGER NOT NULL REFERENCES log_segments (segment_id) ON DELETE CASCADE,
+    PRIMARY KEY (kind, value, segment_id)
+) WITHOUT ROWID;
+
+-- Event counts per user or product, event and hour or day (bucket is the UTC start of the period in
+-- unix time), kept up to date by the trigger below. Compaction leaves them alone.
+CREATE TABLE log_rollups (
+    dimension TEXT NOT NULL,
+    key TEXT NOT NULL,
+    period TEXT NOT NULL,
+    event TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (dimension, period, event, bucket, key)
+) WITHOUT ROWID;
+
+CREATE INDEX log_rollups_key ON log_rollups (dimension, key, period, event, bucket);
+
+CREATE TRIGGER logs_rollups AFTER INSERT ON logs
+BEGIN
+    INSERT INTO log_rollups (dimension, key, period, event, bucket, count)
+    SELECT keys.dimension, keys.key, periods.period, NEW.event, CAST(NEW.created_at / periods.seconds AS INTEGER) * periods.seconds, 1
+    FROM (
+        SELECT 'user' AS dimension, NEW.username AS key
+        UNION ALL
+        SELECT 'product', NEW.name WHERE NEW.name IS NOT NULL AND NEW.name <> 'NULL'
+    ) AS keys
+    CROSS JOIN (SELECT 'hour' AS period, 3600 AS seconds UNION ALL SELECT 'day', 86400) AS periods
+    WHERE true
+    ON CONFLICT (dimension, period, event, bucket, key) DO UPDATE SET count = count + 1;
+END;
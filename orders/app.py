@@ -1,5 +1,6 @@
 """
 This microservice handles order management.
+It uses a SQLite database to store every accepted order and its line items.
 Port 9003
 """
 
@@ -11,102 +12,196 @@ import hashlib
 import re
 import base64
 import hmac
-import requests
+import math
+import time
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from common import client, codec, fanout, jwt_verifier, log_shipper, metrics, resilience, snapshots, streaming, tracing
+from common.db import Database
 
 app = Flask(__name__)
+metrics.instrument(app, "orders")
+tracing.instrument(app, "orders")
+codec.instrument(app)
+resilience.instrument(app, "orders")
 db_name = "orders.db"
-sql_file = "orders.sql"
-db_flag = False
-
-# def create_db():
-# 	conn = sqlite3.connect(db_name)
-# 	with open(sql_file, 'r') as sql_startup:
-# 		init_db = sql_startup.read()
-# 	cursor = conn.cursor()
-# 	cursor.executescript(init_db)
-# 	conn.execute("PRAGMA foreign_keys = ON")
-# 	conn.commit()
-# 	conn.close()
-# 	global db_flag
-# 	db_flag = True
-# 	return conn
-
-# def get_db():
-# 	if not db_flag:
-# 		create_db()
-# 	conn = sqlite3.connect(db_name)
-# 	return conn
+sql_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "orders.sql")
+database = Database(db_name, sql_file)
+
+# Order totals are rounded to cents, half up. Line totals are kept exact.
+CENT = Decimal("0.01")
+
+def create_db(reset=False):
+	# Idempotent: creates the schema once, or drops and recreates it with reset=True.
+	database.init_schema(reset)
+
+def get_db():
+	return database.get()
+
+create_db()
+
+@app.teardown_appcontext
+def release_db(exception):
+	database.release()
+
+@app.route('/ready', methods=['GET'])
+def ready():
+	if not database.ready():
+		return json.dumps({"status": 2}), 503
+	return json.dumps({"status": 1})
 
 @app.route('/clear', methods=['GET'])
 def clear():
-	if os.path.exists(db_name):
-		try:
-			os.remove(db_name)
-		except Exception as e:
-			return f"Error clearing database: {e}"
-	global db_flag
-	db_flag = False
+	create_db(reset=True)
+	jwt_verifier.clear_cache()
 	return "Database Cleared"
 
+snapshots.instrument(app, database, lambda name: jwt_verifier.clear_cache())
+
+def store_order(username, total, lines):
+	# Stores the order and all of its lines in one transaction and returns its id.
+	conn = get_db()
+	cursor = conn.cursor()
+	cursor.execute(
+		"INSERT INTO orders (username, total, item_count, created_at) VALUES (?, ?, ?, ?)",
+		(username, str(total), len(lines), time.time())
+	)
+	order_id = cursor.lastrowid
+	cursor.executemany(
+		"INSERT INTO order_items (order_id, product_name, quantity, unit_price, line_total) VALUES (?, ?, ?, ?, ?)",
+		[(order_id, name, str(quantity), str(unit_price), str(line_total)) for name, quantity, unit_price, line_total in lines]
+	)
+	conn.commit()
+	return order_id
+
+def price_order(order_raw):
+    # Returns (total, lines) for the order, or None if it cannot be priced (status 3).
+    # lines holds one (product, quantity, unit price, line total) per distinct product.
+    if not order_raw:
+        return None
+
+    try:
+        order_list = json.loads(order_raw)
+    except Exception as e:
+        return None
+
+    if not isinstance(order_list, list) or len(order_list) == 0:
+        return None
+
+    # Validate every line item and add up the quantities of repeated products
+    quantities = {}
+    for item in order_list:
+        if not isinstance(item, dict):
+            return None
+        product_name = item.get("product")
+        quantity = item.get("quantity")
+        if not isinstance(product_name, str) or quantity is None:
+            return None
+        if isinstance(quantity, bool) or not isinstance(quantity, (int, float)) or not math.isfinite(quantity):
+            return None
+        quantities[product_name] = quantities.get(product_name, 0) + Decimal(str(quantity))
+
+    # Look up every product in the basket with a single call to the product management microservice
+    product = client.products.lookup(list(quantities))
+
+    if not product or product["status"] == 2 or product["products"] == "NULL":
+        return None
+
+    prices = {prod_data["product_name"]: prod_data["price"] for prod_data in product["products"]}
+    if any(prices.get(product_name) is None for product_name in quantities):
+        return None
+
+    # Price every line in decimal, so the total is exact before it is rounded to cents; a total
+    # too large to be rounded to cents is rejected like any other unpriceable order
+    try:
+        lines = [(product_name, quantity, Decimal(str(prices[product_name]))) for product_name, quantity in quantities.items()]
+        lines = [(product_name, quantity, unit_price, unit_price * quantity) for product_name, quantity, unit_price in lines]
+        total_cost = sum(line[3] for line in lines).quantize(CENT, rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        return None
+    return total_cost, lines
+
 @app.route('/order', methods=['POST'])
 def order():
     # Get the JWT from the HTTP header
     jwt_token = request.headers.get('Authorization')
     if not jwt_token:
         return json.dumps({"status": 2, "cost": "NULL"})
-    
-    # Verify the JWT with the user management microservice
-    URL = "http://user:5000/verify"
-    PARAMS = {'jwt': jwt_token}
-    r = requests.get(url=URL, params=PARAMS)
-    user_data = r.json()
-    if user_data["status"] == 2:
+
+    # Check the JWT signature locally first, so a forged token causes no downstream call, then ask
+    # the user service whether the user exists while the order is priced; a failed verification
+    # still answers status 2 whatever the pricing returned
+    if jwt_verifier.token_username(jwt_token) is None:
         return json.dumps({"status": 2, "cost": "NULL"})
-    
-    # Parse the JSON payload and extract the 'order' parameter
     order_raw = request.form.get('order')
-    if not order_raw:
-        return json.dumps({"status": 3, "cost": "NULL"})
-    
-    try:
-        order_list = json.loads(order_raw)
-    except Exception as e:
-        return json.dumps({"status": 3, "cost": "NULL"})
-    
-    if not isinstance(order_list, list) or len(order_list) == 0:
+    user_data, priced = fanout.gather(
+        fanout.Call("user", lambda: jwt_verifier.verify(jwt_token), lambda data: data["status"] == 2),
+        fanout.Call("products", lambda: price_order(order_raw), lambda result: result is None),
+    )
+    if user_data["status"] == 2:
+        return json.dumps({"status": 2, "cost": "NULL"})
+
+    if priced is None:
         return json.dumps({"status": 3, "cost": "NULL"})
-    
-    total_cost = 0.0
-    # Process each product in the order
-    for item in order_list:
-        product_name = item["product"]
-        quantity = item["quantity"]
-        if product_name is None or quantity is None:
-            return json.dumps({"status": 3, "cost": "NULL"})
-        
-        # Verify product with the product management microservice
-        URL = "http://products:5000/product"
-        PARAMS = {"product_name": product_name}
-        r = requests.get(url=URL, params=PARAMS)
-        product = r.json()
-
-        if not product or product["status"] == 2 or product["products"] == "NULL":
-            return json.dumps({"status": 3, "cost": "NULL"})
-        
-        prod_data = product["products"]
-        prod_data = prod_data[0]
-        price = prod_data["price"]
-        
-        if price is None:
-            return json.dumps({"status": 3, "cost": "NULL"})
-        
-        total_cost += price * quantity
+
+    total_cost, lines = priced
+    store_order(user_data["user"], total_cost, lines)
 
     # Log the event
-    URL = "http://logs:5000/log"
-    PARAMS = {"event": "order", "user": user_data["user"], "name": "NULL"}
-    log = requests.post(url=URL, data=PARAMS)
-    log = log.json()
+    log_shipper.log_event("order", user_data["user"], "NULL")
+
+    return json.dumps({"status": 1, "cost": str(total_cost)})
+
+@app.route('/order_history', methods=['GET'])
+def order_history():
+	# The caller's orders, oldest first, keyset paginated by order_id (after, limit) or streamed as NDJSON.
+	jwt_token = request.headers.get('Authorization')
+	if not jwt_token:
+		return json.dumps({"status": 2, "data": "NULL"})
+	user_data = jwt_verifier.verify(jwt_token)
+	if user_data["status"] == 2:
+		return json.dumps({"status": 2, "data": "NULL"})
+
+	try:
+		after, limit = streaming.pagination_args(request.args)
+	except ValueError:
+		return json.dumps({"status": 3, "data": "NULL"})
+
+	rows = streaming.keyset_rows(
+		get_db(),
+		"""SELECT order_id AS row_id, order_id, total, item_count, created_at FROM orders
+		WHERE username = ? AND order_id > ? ORDER BY order_id LIMIT ?""",
+		(user_data["user"],), after, limit
+	)
+	if streaming.wants_ndjson(request.args):
+		return streaming.ndjson_response(rows)
+	return streaming.page_response(rows, limit)
+
+@app.route('/order_history/<int:order_id>', methods=['GET'])
+def order_items(order_id):
+	# Line items of one of the caller's orders, paginated the same way as /order_history.
+	jwt_token = request.headers.get('Authorization')
+	if not jwt_token:
+		return json.dumps({"status": 2, "data": "NULL"})
+	user_data = jwt_verifier.verify(jwt_token)
+	if user_data["status"] == 2:
+		return json.dumps({"status": 2, "data": "NULL"})
+
+	try:
+		after, limit = streaming.pagination_args(request.args)
+	except ValueError:
+		return json.dumps({"status": 3, "data": "NULL"})
+
+	cursor = get_db().cursor()
+	cursor.execute("SELECT 1 FROM orders WHERE order_id = ? AND username = ?", (order_id, user_data["user"]))
+	if cursor.fetchone() is None:
+		return json.dumps({"status": 3, "data": "NULL"})
 
-    total_cost = format(total_cost, '.2f')
-    return json.dumps({"status": 1, "cost": total_cost})
\ No newline at end of file
+	rows = streaming.keyset_rows(
+		get_db(),
+		"""SELECT rowid AS row_id, product_name, quantity, unit_price, line_total FROM order_items
+		WHERE order_id = ? AND rowid > ? ORDER BY rowid LIMIT ?""",
+		(order_id,), after, limit
+	)
+	if streaming.wants_ndjson(request.args):
+		return streaming.ndjson_response(rows)
+	return streaming.page_response(rows, limit)
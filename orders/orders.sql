@@ -0,0 +1,24 @@
+DROP TABLE IF EXISTS order_items;
+DROP TABLE IF EXISTS orders;
+
+-- One row per accepted order. Amounts are exact decimal strings.
+CREATE TABLE orders (
+    order_id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    total TEXT NOT NULL,
+    item_count INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+
+CREATE INDEX orders_username ON orders (username, order_id);
+
+-- One row per product in an order; repeated products are combined into one line.
+CREATE TABLE order_items (
+    order_id INTEGER NOT NULL REFERENCES orders (order_id) ON DELETE CASCADE,
+    product_name TEXT NOT NULL,
+    quantity TEXT NOT NULL,
+    unit_price TEXT NOT NULL,
+    line_total TEXT NOT NULL,
+    -- Also the index that looks up the lines of an order.
+    UNIQUE (order_id, product_name)
+);
@@ -9,50 +9,143 @@ import sqlite3
 import os
 from flask import Flask, request
 import json
-import requests
+import math
+import re
+import threading
+from common import client, codec, jwt_verifier, log_shipper, metrics, resilience, snapshots, streaming, tracing
+from common.cache import LRUCache, MISSING
+from common.db import Database
 
 app = Flask(__name__)
+metrics.instrument(app, "products")
+tracing.instrument(app, "products")
+codec.instrument(app)
+resilience.instrument(app, "products")
 db_name = "products.db"
-sql_file = "products.sql"
-db_flag = False
+sql_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "products.sql")
+database = Database(db_name, sql_file, reseed="UPDATE feed_state SET epoch = lower(hex(randomblob(8)));")
 
-def create_db():
-	conn = sqlite3.connect(db_name)
-	with open(sql_file, 'r') as sql_startup:
-		init_db = sql_startup.read()
-	cursor = conn.cursor()
-	cursor.executescript(init_db)
-	conn.execute("PRAGMA foreign_keys = ON")
-	conn.commit()
-	conn.close()
-	global db_flag
-	db_flag = True
-	return conn
+# Maximum number of names bound into a single IN (...) query.
+BATCH_CHUNK_SIZE = 500
+
+# Records validated and written per transaction by /import_products.
+IMPORT_CHUNK_SIZE = 1000
+
+# Default and maximum number of products returned by a full text query.
+MATCH_LIMIT = 20
+MAX_MATCH_LIMIT = 100
+
+# Default and maximum number of products returned by one /changes call.
+CHANGES_PAGE_SIZE = 1000
+
+# Name and category lookups are served from memory. Names that do not exist are cached as None,
+# empty categories as an empty list. Writes invalidate exactly the entries they touch.
+product_cache = LRUCache(int(os.environ.get("PRODUCT_CACHE_SIZE", "10000")))
+
+# Change feed position (epoch, seq) the cache is known to be in step with. Other worker processes
+# write to the same database without invalidating this process's cache, so reads compare it with
+# feed_state and drop the cache when someone else has written in the meantime.
+cache_position = None
+cache_position_lock = threading.Lock()
+
+def create_db(reset=False):
+	# Idempotent: creates the schema once, or drops and recreates it with reset=True.
+	database.init_schema(reset)
 
 def get_db():
-	if not db_flag:
-		create_db()
-	conn = sqlite3.connect(db_name)
-	return conn
+	return database.get()
+
+create_db()
+
+@app.teardown_appcontext
+def release_db(exception):
+	database.release()
+
+def notify_search(product_names, categories):
+	# Ask search to pull the change feed now instead of on its next poll and to drop its cached
+	# results for these products and categories. Best effort only: the replica catches up by
+	# itself if search is unavailable, and cached results expire.
+	try:
+		client.search.invalidate(product_names, categories)
+	except Exception:
+		pass
+
+def feed_position():
+	cursor = get_db().cursor()
+	cursor.execute("SELECT epoch, seq FROM feed_state")
+	return cursor.fetchone()
+
+def check_cache():
+	# Called once per read request, before the cache is used.
+	global cache_position
+	position = feed_position()
+	with cache_position_lock:
+		if position != cache_position:
+			product_cache.clear()
+			cache_position = position
+
+def note_write(changes):
+	# Called after a write has invalidated its own cache entries. If nothing else was written
+	# in between, the cache is still in step with the database.
+	global cache_position
+	position = feed_position()
+	with cache_position_lock:
+		if cache_position is not None and position == (cache_position[0], cache_position[1] + changes):
+			cache_position = position
+
+def lookup_name(product_name):
+	# Returns (price, category), or None if the product does not exist.
+	def load():
+		cursor = get_db().cursor()
+		cursor.execute("SELECT price, category FROM products WHERE name = ?", (product_name,))
+		return cursor.fetchone()
+	return product_cache.get_or_load(("name", product_name), load)
+
+def lookup_category(category):
+	# Returns a list of (name, price) for every product in the category.
+	def load():
+		cursor = get_db().cursor()
+		cursor.execute("SELECT name, price FROM products WHERE category = ?", (category,))
+		return cursor.fetchall()
+	return product_cache.get_or_load(("category", category), load)
+
+@app.route('/ready', methods=['GET'])
+def ready():
+	if not database.ready():
+		return json.dumps({"status": 2}), 503
+	return json.dumps({"status": 1})
 
 @app.route('/clear', methods=['GET'])
 def clear():
-	if os.path.exists(db_name):
-		try:
-			os.remove(db_name)
-		except Exception as e:
-			return f"Error clearing database: {e}"
-	global db_flag
-	db_flag = False
+	create_db(reset=True)
+	clear_caches()
 	return "Database Cleared"
 
+def clear_caches(name=None):
+	global cache_position
+	with cache_position_lock:
+		product_cache.clear()
+		cache_position = None
+	jwt_verifier.clear_cache()
+
+snapshots.instrument(app, database, clear_caches)
+
 @app.route('/', methods=(['GET']))
 def index():
+	if streaming.requested(request.args):
+		try:
+			after, limit = streaming.pagination_args(request.args)
+		except ValueError:
+			return json.dumps({"status": 2, "data": "NULL"})
+		rows = streaming.keyset_rows(get_db(), "SELECT rowid AS row_id, name, price, category FROM products WHERE rowid > ? ORDER BY rowid LIMIT ?", (), after, limit)
+		if streaming.wants_ndjson(request.args):
+			return streaming.ndjson_response(rows)
+		return streaming.page_response(rows, limit)
+
 	conn = get_db()
 	cursor = conn.cursor()
-	cursor.execute("SELECT * FROM products;")
+	cursor.execute("SELECT name, price, category FROM products;")
 	result = cursor.fetchall()
-	conn.close()
 
 	return result
 
@@ -77,11 +170,8 @@ def create_product():
 	if not category:
 		return json.dumps({"status": 2})
 	
-	# Check if the user is an employee by calling the users microservice.
-	URL = "http://user:5000/verify"
-	PARAMS = {'jwt': jwt_token}
-	r = requests.get(url=URL, params=PARAMS)
-	user_data = r.json()
+	# Check if the user is an employee.
+	user_data = jwt_verifier.verify(jwt_token)
 
 	if user_data["employee"] == "NULL" or user_data["employee"] == "False":
 		return json.dumps({"status": 2})
@@ -91,7 +181,6 @@ def create_product():
 	cursor = conn.cursor()
 	cursor.execute("SELECT * FROM products WHERE name = ?", (name,))
 	if cursor.fetchone() is not None:
-		conn.close()
 		return json.dumps({"status": 2})
 	
 	# Insert the new product record into the products table.
@@ -100,13 +189,12 @@ def create_product():
 		(name, price, category)
 	)
 	conn.commit()
-	conn.close()
+	product_cache.invalidate(("name", name), ("category", category))
+	note_write(1)
 
 	# Log the event
-	URL = "http://logs:5000/log"
-	PARAMS = {"event": "product_creation", "user": user_data["user"], "name": name}
-	log = requests.post(url=URL, data=PARAMS)
-	log = log.json()
+	log_shipper.log_event("product_creation", user_data["user"], name)
+	notify_search([name], [category])
 
 	return json.dumps({"status": 1})
 	
@@ -118,10 +206,7 @@ def edit_product():
 	new_category = request.form.get('new_category')
 	
 	# Check if the user is an employee.
-	URL = "http://user:5000/verify"
-	PARAMS = {'jwt': jwt_token}
-	r = requests.get(url=URL, params=PARAMS)
-	user_data = r.json()
+	user_data = jwt_verifier.verify(jwt_token)
 	
 	if user_data["status"] == 2:
 		return json.dumps({"status": 2})
@@ -131,6 +216,10 @@ def edit_product():
 	# Connect to database and update the product.
 	conn = get_db()
 	cursor = conn.cursor()
+
+	# Remember the current category so its cached listing can be invalidated.
+	cursor.execute("SELECT category FROM products WHERE name = ?", (product_name,))
+	row = cursor.fetchone()
 	
 	if new_price:
 		# Updating price: replace the current value with the new one.
@@ -140,48 +229,268 @@ def edit_product():
 		cursor.execute("UPDATE products SET category = ? WHERE name = ?", (new_category, product_name))
 
 	conn.commit()
-	conn.close()
+	stale = [("name", product_name)]
+	if row is not None:
+		stale.append(("category", row[0]))
+	if new_category:
+		stale.append(("category", new_category))
+	product_cache.invalidate(*stale)
+	note_write(1 if row is not None and (new_price or new_category) else 0)
 
 	# Log the event
-	URL = "http://logs:5000/log"
-	PARAMS = {"event": "product_edit", "user": user_data["user"], "name": product_name}
-	log = requests.post(url=URL, data=PARAMS)
-	log = log.json()
+	log_shipper.log_event("product_edit", user_data["user"], product_name)
+	notify_search([product_name], [value for kind, value in stale if kind == "category"])
 
 	return json.dumps({"status": 1})
 
+def parse_price(value):
+	# Returns the price as a float, or None if it is missing or not a finite number.
+	if value is None or value == "" or isinstance(value, bool):
+		return None
+	try:
+		price = float(value)
+	except (TypeError, ValueError):
+		return None
+	return price if math.isfinite(price) else None
+
+def existing_products(cursor, names):
+	# Returns {name: (price, category)} for the names that exist.
+	names = list(names)
+	found = {}
+	for start in range(0, len(names), BATCH_CHUNK_SIZE):
+		chunk = names[start:start + BATCH_CHUNK_SIZE]
+		placeholders = ", ".join("?" for _ in chunk)
+		cursor.execute(f"SELECT name, price, category FROM products WHERE name IN ({placeholders})", chunk)
+		found.update((row[0], (row[1], row[2])) for row in cursor.fetchall())
+	return found
+
+def import_chunk(records, username, stale):
+	# Creates or updates one chunk of products in one transaction and returns one result per record.
+	# A new product needs a name, price and category; an existing one takes a new price, category
+	# or both. Repeated names are applied in order. Log events are queued but not waited for, and
+	# the cache keys the chunk made stale are added to `stale` for search.
+	conn = get_db()
+	cursor = conn.cursor()
+	names = {record.get('name') for record in records if record and isinstance(record.get('name'), str)}
+	current = existing_products(cursor, names)
+
+	results = []
+	upserts = {}
+	price_updates = {}
+	events = []
+	touched = set()
+	for record in records:
+		name = record.get('name') if record else None
+		if not name or not isinstance(name, str):
+			results.append({"status": 2, "action": "NULL"})
+			continue
+		price = parse_price(record.get('price'))
+		category = record.get('category') or None
+		if (record.get('price') not in (None, "") and price is None) or (category is not None and not isinstance(category, str)):
+			results.append({"status": 2, "action": "NULL"})
+			continue
+
+		old = current.get(name)
+		if old is None:
+			if price is None or category is None:
+				results.append({"status": 2, "action": "NULL"})
+				continue
+			action, event = "created", "product_creation"
+		else:
+			price = old[0] if price is None else price
+			category = old[1] if category is None else category
+			if (price, category) == old:
+				results.append({"status": 1, "action": "unchanged"})
+				continue
+			action, event = "updated", "product_edit"
+			touched.add(("category", old[1]))
+
+		# Price only changes are plain updates, which leave the full text index alone.
+		if old is not None and category == old[1] and name not in upserts:
+			price_updates[name] = (price, name)
+		else:
+			price_updates.pop(name, None)
+			upserts[name] = (name, price, category)
+		current[name] = (price, category)
+		touched.update((("name", name), ("category", category)))
+		events.append({"event": event, "user": username, "name": name})
+		results.append({"status": 1, "action": action})
+
+	cursor.executemany(
+		"""INSERT INTO products (name, price, category) VALUES (?, ?, ?)
+		ON CONFLICT (name) DO UPDATE SET price = excluded.price, category = excluded.category""",
+		list(upserts.values())
+	)
+	cursor.executemany("UPDATE products SET price = ? WHERE name = ?", list(price_updates.values()))
+	conn.commit()
+
+	if events:
+		product_cache.invalidate(*touched)
+		note_write(len(upserts) + len(price_updates))
+		log_shipper.log_events(events)
+		stale.update(touched)
+	return results
+
+@app.route('/import_products', methods=['POST'])
+def import_products():
+	# Bulk create and update of products for catalog and price feeds. The JWT is verified once,
+	# records are processed in chunks as they are read, and one result per record is streamed
+	# back as NDJSON: {"row", "name", "status", "action"} with action created, updated or unchanged.
+	jwt_token = request.headers.get('Authorization')
+	if not jwt_token:
+		return json.dumps({"status": 2})
+	user_data = jwt_verifier.verify(jwt_token)
+	if user_data["status"] == 2:
+		return json.dumps({"status": 2})
+	if user_data["employee"] != "True":
+		return json.dumps({"status": 3})
+
+	def results():
+		row_number = 0
+		stale = set()
+		for chunk in streaming.chunks(streaming.import_records(), IMPORT_CHUNK_SIZE):
+			for record, result in zip(chunk, import_chunk(chunk, user_data["user"], stale)):
+				row_number += 1
+				name = record.get('name') if record else None
+				yield {"row": row_number, "name": name if isinstance(name, str) and name else "NULL", **result}
+		# Tell search about every product and category the import changed in one call.
+		if stale:
+			notify_search([value for kind, value in stale if kind == "name"], [value for kind, value in stale if kind == "category"])
+
+	return streaming.ndjson_response(results())
+
+def match_products(query, limit):
+	# Ranked full text search where every word of the query is matched as a prefix,
+	# so "chee" finds "cheese" and "ched che" finds "cheddar cheese".
+	words = re.findall(r"\w+", query)
+	if not words:
+		return []
+	match = " ".join(f'"{word}"*' for word in words)
+	cursor = get_db().cursor()
+	cursor.execute(
+		"""SELECT p.name, p.price, p.category FROM products_fts JOIN products p ON p.rowid = products_fts.rowid
+		WHERE products_fts MATCH ? ORDER BY rank LIMIT ?""",
+		(match, limit)
+	)
+	return cursor.fetchall()
+
 @app.route('/product', methods=['GET'])
 def product():
 	product_name = request.args.get('product_name')
 	category = request.args.get('category')
+	query = request.args.get('q')
+	check_cache()
 	
 	if product_name:
-		# Connect to the database and retrieve the product price.
-		conn = get_db()
-		cursor = conn.cursor()
-		cursor.execute("SELECT price, category FROM products WHERE name = ?", (product_name,))
-		product = cursor.fetchone()
-		conn.close()
+		# Retrieve the product price from the cache or the database.
+		product = lookup_name(product_name)
 		
 		if not product:
-			return json.dumps({"status": 2, "products": "NULL"})
+			return codec.response({"status": 2, "products": "NULL"})
 		
 		product_list = [{"product_name": product_name, "price": product[0], "category": product[1]}]
 		
-		return json.dumps({"status": 1, "products": product_list})
+		return codec.response({"status": 1, "products": product_list})
 	
 	if category:
-		# Connect to the database and retrieve all products in the specified category.
-		conn = get_db()
-		cursor = conn.cursor()
-		cursor.execute("SELECT name, price FROM products WHERE category = ?", (category,))
-		products = cursor.fetchall()
-		conn.close()
+		# Retrieve all products in the specified category from the cache or the database.
+		products = lookup_category(category)
 		
 		if not products:
-			return json.dumps({"status": 2, "products": "NULL"})
+			return codec.response({"status": 2, "products": "NULL"})
 		
 		product_list = [{"product_name": prod[0], "price": prod[1], "category": category} for prod in products]
-		return json.dumps({"status": 1, "products": product_list})
-	
-	return json.dumps({"status": 2, "products": "NULL"})
+		return codec.response({"status": 1, "products": product_list})
+
+	if query:
+		try:
+			limit = max(1, min(int(request.args.get('limit', MATCH_LIMIT)), MAX_MATCH_LIMIT))
+		except ValueError:
+			return codec.response({"status": 2, "products": "NULL"})
+
+		# Retrieve the best matching products by name or category.
+		products = match_products(query, limit)
+
+		if not products:
+			return codec.response({"status": 2, "products": "NULL"})
+
+		product_list = [{"product_name": prod[0], "price": prod[1], "category": prod[2]} for prod in products]
+		return codec.response({"status": 1, "products": product_list})
+
+	return codec.response({"status": 2, "products": "NULL"})
+
+@app.route('/products/batch', methods=['POST'])
+def products_batch():
+	# The names are sent as a JSON encoded list, the same way orders sends its order list.
+	names_raw = request.form.get('product_names')
+	if not names_raw:
+		return codec.response({"status": 2, "products": "NULL"})
+
+	try:
+		names = json.loads(names_raw)
+	except Exception:
+		return codec.response({"status": 2, "products": "NULL"})
+
+	if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+		return codec.response({"status": 2, "products": "NULL"})
+
+	# Serve what we can from the cache, then look the rest up with one IN query per chunk,
+	# staying below SQLite's variable limit.
+	names = list(dict.fromkeys(names))
+	check_cache()
+	found = {}
+	missing = []
+	for name in names:
+		cached = product_cache.get(("name", name))
+		if cached is MISSING:
+			missing.append(name)
+		elif cached is not None:
+			found[name] = cached
+
+	conn = get_db()
+	cursor = conn.cursor()
+	for start in range(0, len(missing), BATCH_CHUNK_SIZE):
+		chunk = missing[start:start + BATCH_CHUNK_SIZE]
+		generation = product_cache.generation()
+		placeholders = ", ".join("?" for _ in chunk)
+		cursor.execute(f"SELECT name, price, category FROM products WHERE name IN ({placeholders})", chunk)
+		rows = {prod[0]: (prod[1], prod[2]) for prod in cursor.fetchall()}
+		for name in chunk:
+			product_cache.put(("name", name), rows.get(name), generation)
+		found.update(rows)
+
+	product_list = [{"product_name": name, "price": found[name][0], "category": found[name][1]} for name in names if name in found]
+
+	# Names that do not exist are simply left out, callers compare against what they asked for.
+	return codec.response({"status": 1, "products": product_list})
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+	return json.dumps({"status": 1, "cache": product_cache.stats()})
+
+@app.route('/changes', methods=['GET'])
+def changes():
+	# Change feed: every product created or edited after version `since`, oldest first.
+	try:
+		since = int(request.args.get('since', 0))
+		# At least one entry per page, so a client following "more" always makes progress.
+		limit = max(1, min(int(request.args.get('limit', CHANGES_PAGE_SIZE)), CHANGES_PAGE_SIZE))
+		if not 0 <= since < 2 ** 63:
+			raise ValueError("since out of range")
+	except ValueError:
+		return codec.response({"status": 2, "products": "NULL"})
+
+	conn = get_db()
+	cursor = conn.cursor()
+	cursor.execute("SELECT epoch FROM feed_state")
+	epoch = cursor.fetchone()[0]
+	cursor.execute(
+		"SELECT rowid, name, price, category, version FROM products WHERE version > ? ORDER BY version LIMIT ?",
+		(since, limit)
+	)
+	rows = cursor.fetchall()
+
+	product_list = [{"position": prod[0], "product_name": prod[1], "price": prod[2], "category": prod[3], "version": prod[4]} for prod in rows]
+	seq = rows[-1][4] if rows else since
+	return codec.response({"status": 1, "epoch": epoch, "seq": seq, "more": len(rows) == limit, "products": product_list})
@@ -1,7 +1,60 @@
 DROP TABLE IF EXISTS products;
+DROP TABLE IF EXISTS feed_state;
+DROP TABLE IF EXISTS products_fts;
 
 CREATE TABLE products (
     name TEXT PRIMARY KEY,
     price REAL NOT NULL,
-    category TEXT NOT NULL
-);
\ No newline at end of file
+    category TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX products_category ON products (category);
+CREATE INDEX products_version ON products (version);
+
+-- Change feed state: seq is the version handed to the last changed product,
+-- epoch identifies this copy of the table so replicas notice when it is recreated.
+CREATE TABLE feed_state (
+    epoch TEXT NOT NULL,
+    seq INTEGER NOT NULL
+);
+
+INSERT INTO feed_state (epoch, seq) VALUES (lower(hex(randomblob(8))), 0);
+
+CREATE TRIGGER products_insert_version AFTER INSERT ON products
+BEGIN
+    UPDATE feed_state SET seq = seq + 1;
+    UPDATE products SET version = (SELECT seq FROM feed_state) WHERE name = NEW.name;
+END;
+
+CREATE TRIGGER products_update_version AFTER UPDATE OF price, category ON products
+BEGIN
+    UPDATE feed_state SET seq = seq + 1;
+    UPDATE products SET version = (SELECT seq FROM feed_state) WHERE name = NEW.name;
+END;
+
+
+-- Full text index over name and category, with prefix indexes for short partial words.
+CREATE VIRTUAL TABLE products_fts USING fts5 (
+    name,
+    category,
+    content = 'products',
+    content_rowid = 'rowid',
+    prefix = '2 3'
+);
+
+CREATE TRIGGER products_fts_insert AFTER INSERT ON products
+BEGIN
+    INSERT INTO products_fts (rowid, name, category) VALUES (NEW.rowid, NEW.name, NEW.category);
+END;
+
+CREATE TRIGGER products_fts_update AFTER UPDATE OF name, category ON products
+BEGIN
+    INSERT INTO products_fts (products_fts, rowid, name, category) VALUES ('delete', OLD.rowid, OLD.name, OLD.category);
+    INSERT INTO products_fts (rowid, name, category) VALUES (NEW.rowid, NEW.name, NEW.category);
+END;
+
+CREATE TRIGGER products_fts_delete AFTER DELETE ON products
+BEGIN
+    INSERT INTO products_fts (products_fts, rowid, name, category) VALUES ('delete', OLD.rowid, OLD.name, OLD.category);
+END;
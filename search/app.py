@@ -12,43 +12,452 @@ import hashlib
 import re
 import base64
 import hmac
-import requests
+import fcntl
+import threading
+import time
+from common import client, codec, fanout, jwt_verifier, log_shipper, metrics, resilience, snapshots, tracing
+from common.cache import LRUCache, MISSING
+from common.db import Database
 
 app = Flask(__name__)
+metrics.instrument(app, "search")
+tracing.instrument(app, "search")
+codec.instrument(app)
+resilience.instrument(app, "search")
 db_name = "search.db"
-sql_file = "search.sql"
-db_flag = False
-
-# def create_db():
-# 	conn = sqlite3.connect(db_name)
-# 	with open(sql_file, 'r') as sql_startup:
-# 		init_db = sql_startup.read()
-# 	cursor = conn.cursor()
-# 	cursor.executescript(init_db)
-# 	conn.execute("PRAGMA foreign_keys = ON")
-# 	conn.commit()
-# 	conn.close()
-# 	global db_flag
-# 	db_flag = True
-# 	return conn
-
-# def get_db():
-# 	if not db_flag:
-# 		create_db()
-# 	conn = sqlite3.connect(db_name)
-# 	return conn
+sql_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "search.sql")
+database = Database(db_name, sql_file, reseed="UPDATE cache_state SET epoch = lower(hex(randomblob(8)));")
+
+# The local catalog replica answers searches while it is at most REPLICA_MAX_LAG seconds behind
+# products and logs. It is refreshed every REPLICA_POLL_INTERVAL seconds, and sooner when products
+# reports a write; until then searches are answered by products and logs.
+REPLICA_ENABLED = os.environ.get("SEARCH_REPLICA", "1") == "1"
+REPLICA_POLL_INTERVAL = float(os.environ.get("SEARCH_REPLICA_POLL_INTERVAL", "0.5"))
+REPLICA_MAX_LAG = float(os.environ.get("SEARCH_REPLICA_MAX_LAG", "2"))
+
+replica_lock = threading.Lock()
+# Set by /invalidate to wake the poller, when it runs in the same worker process.
+replica_nudge = threading.Event()
+replica_poller = None
+replica_pid = None
+
+# Search results are cached for SEARCH_CACHE_TTL seconds, then served for up to SEARCH_CACHE_STALE
+# more seconds while they are recomputed in the background. Products reports every write through
+# /invalidate, and the replica records every change it pulls, in the cache_invalidations table,
+# which every worker process reads before using its cache.
+CACHE_ENABLED = os.environ.get("SEARCH_CACHE", "1") == "1"
+CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", "30"))
+CACHE_STALE = float(os.environ.get("SEARCH_CACHE_STALE", "30"))
+# Invalidations are kept until every entry cached before them has expired.
+INVALIDATION_RETENTION = CACHE_TTL + CACHE_STALE + 60
+
+# Products do not wait for their log event to be stored, so a product written a moment ago may not
+# have a last modifier yet. Search asks logs again every SEARCH_LAST_MOD_RETRY seconds for up to
+# SEARCH_LAST_MOD_WAIT seconds before it gives up on such a product.
+LAST_MOD_WAIT = float(os.environ.get("SEARCH_LAST_MOD_WAIT", "1"))
+LAST_MOD_RETRY = float(os.environ.get("SEARCH_LAST_MOD_RETRY", "0.05"))
+
+# Names and categories are bound into IN (...) queries this many at a time.
+BATCH_CHUNK_SIZE = 500
+
+search_cache = LRUCache(int(os.environ.get("SEARCH_CACHE_SIZE", "10000")))
+cache_counters = {"hits": 0, "stale_hits": 0, "misses": 0, "revalidations": 0}
+cache_epoch = None
+invalidations_seen = 0
+revalidating = set()
+cache_lock = threading.Lock()
+metrics.registry.define("search_cache_lookups_total", "counter", "Search result cache lookups, by result (hit, stale_hit or miss).")
+
+def create_db(reset=False):
+	# Idempotent: creates the schema once, or drops and recreates it with reset=True.
+	database.init_schema(reset)
+
+def get_db():
+	return database.get()
+
+create_db()
+
+@app.teardown_appcontext
+def release_db(exception):
+	database.release()
+
+def fetch_feed(cursor, feed, fetch):
+	# Fetches every page of one change feed the replica has not applied yet, starting over if the
+	# source was recreated, without writing anything. Returns the feed state the pages follow, the
+	# state they lead to, and the pages, where None means "empty the replica first".
+	cursor.execute("SELECT epoch, seq FROM replica_state WHERE feed = ?", (feed,))
+	state = cursor.fetchone()
+	epoch, seq = state if state else (None, 0)
+	start = (epoch, seq)
+	pages = []
+	while True:
+		page = fetch(seq)
+		if page["status"] != 1:
+			raise Exception(f"{feed} change feed unavailable")
+		if page["epoch"] != epoch:
+			pages = [None]
+			if seq != 0:
+				page = fetch(0)
+			epoch = page["epoch"]
+		pages.append(page)
+		seq = page["seq"]
+		if not page["more"]:
+			return start, (epoch, seq), pages
+
+def apply_feed(cursor, feed, fetched, apply, fetched_at):
+	# Applies pages fetched by fetch_feed, unless another sync moved the feed on in the meantime.
+	start, (epoch, seq), pages = fetched
+	cursor.execute("SELECT epoch, seq FROM replica_state WHERE feed = ?", (feed,))
+	state = cursor.fetchone()
+	if (tuple(state) if state else (None, 0)) != start:
+		return
+	for page in pages:
+		apply(page)
+	cursor.execute(
+		"""INSERT INTO replica_state (feed, epoch, seq, synced_at) VALUES (?, ?, ?, ?)
+		ON CONFLICT (feed) DO UPDATE SET epoch = excluded.epoch, seq = excluded.seq, synced_at = excluded.synced_at""",
+		(feed, epoch, seq, fetched_at)
+	)
+
+def replica_lookup(cursor, query, names):
+	# Returns {name: value} for a "SELECT name, value ... WHERE name IN ({})" query over the replica.
+	found = {}
+	for start in range(0, len(names), BATCH_CHUNK_SIZE):
+		chunk = names[start:start + BATCH_CHUNK_SIZE]
+		cursor.execute(query.format(", ".join("?" * len(chunk))), chunk)
+		found.update(cursor.fetchall())
+	return found
+
+def record_invalidations(cursor, stale):
+	# Adds (kind, value) pairs for every worker's cache to drop, and forgets the expired ones.
+	now = time.time()
+	cursor.executemany(
+		"INSERT INTO cache_invalidations (kind, value, created_at) VALUES (?, ?, ?)",
+		[(kind, value, now) for kind, value in set(stale)]
+	)
+	cursor.execute("DELETE FROM cache_invalidations WHERE created_at < ?", (now - INVALIDATION_RETENTION,))
+
+def sync_replica():
+	conn = get_db()
+	cursor = conn.cursor()
+	# Cached results touched by the changes pulled in, dropped in the same transaction.
+	stale = []
+
+	def apply_products(page):
+		if page is None:
+			cursor.execute("DELETE FROM replica_products")
+			stale.append(("all", ""))
+			return
+		names = [prod["product_name"] for prod in page["products"]]
+		old_categories = replica_lookup(cursor, "SELECT name, category FROM replica_products WHERE name IN ({})", names)
+		stale.extend(("name", name) for name in names)
+		stale.extend(("category", category) for category in old_categories.values())
+		stale.extend(("category", prod["category"]) for prod in page["products"])
+		cursor.executemany(
+			"""INSERT INTO replica_products (name, price, category, position, version) VALUES (?, ?, ?, ?, ?)
+			ON CONFLICT (name) DO UPDATE SET price = excluded.price, category = excluded.category, version = excluded.version
+			WHERE excluded.version > replica_products.version""",
+			[(prod["product_name"], prod["price"], prod["category"], prod["position"], prod["version"]) for prod in page["products"]]
+		)
+
+	def apply_last_mods(page):
+		if page is None:
+			cursor.execute("DELETE FROM replica_last_mod")
+			stale.append(("all", ""))
+			return
+		# Every logged event moves a product's last_mod row, but cached results only show the username.
+		names = [entry["product_name"] for entry in page["last_mod"]]
+		old_users = replica_lookup(cursor, "SELECT name, username FROM replica_last_mod WHERE name IN ({})", names)
+		changed = [entry["product_name"] for entry in page["last_mod"] if old_users.get(entry["product_name"]) != entry["last_mod"]]
+		categories = replica_lookup(cursor, "SELECT name, category FROM replica_products WHERE name IN ({})", changed)
+		stale.extend(("name", name) for name in changed)
+		stale.extend(("category", category) for category in categories.values())
+		cursor.executemany(
+			"""INSERT INTO replica_last_mod (name, username, row_id) VALUES (?, ?, ?)
+			ON CONFLICT (name) DO UPDATE SET username = excluded.username, row_id = excluded.row_id
+			WHERE excluded.row_id > replica_last_mod.row_id""",
+			[(entry["product_name"], entry["last_mod"], entry["row_id"]) for entry in page["last_mod"]]
+		)
+
+	with replica_lock:
+		# Both feeds are fetched before anything is written, so the write lock on search.db is
+		# only held while the pages are applied, never across a call to another service.
+		# synced_at is when the fetch started: the replica holds every change made before then.
+		fetched_at = time.time()
+		products_feed = fetch_feed(cursor, "products", client.products.changes)
+		last_mod_feed = fetch_feed(cursor, "last_mod", client.logs.last_mod_changes)
+		try:
+			conn.execute("BEGIN IMMEDIATE")
+			apply_feed(cursor, "products", products_feed, apply_products, fetched_at)
+			apply_feed(cursor, "last_mod", last_mod_feed, apply_last_mods, fetched_at)
+			if stale and CACHE_ENABLED:
+				record_invalidations(cursor, stale)
+			conn.commit()
+		except Exception:
+			conn.rollback()
+			raise
+
+def poll_replica():
+	# Only one worker process polls at a time: the others wait on the poller lock, and one of them
+	# takes over if the process holding it exits.
+	lock_file = open(db_name + ".replica.lock", "a")
+	fcntl.flock(lock_file, fcntl.LOCK_EX)
+	while True:
+		replica_nudge.wait(REPLICA_POLL_INTERVAL)
+		replica_nudge.clear()
+		try:
+			sync_replica()
+		except Exception:
+			pass
+
+@app.before_request
+def start_replica_poller():
+	# Started lazily in every worker process, since a forked worker has no threads.
+	global replica_poller, replica_pid
+	if REPLICA_ENABLED and (replica_poller is None or replica_pid != os.getpid()):
+		with replica_lock:
+			if replica_poller is None or replica_pid != os.getpid():
+				replica_pid = os.getpid()
+				replica_poller = threading.Thread(target=poll_replica, name="replica-poller", daemon=True)
+				replica_poller.start()
+
+def replica_fresh():
+	cursor = get_db().cursor()
+	cursor.execute("SELECT MIN(synced_at), MAX(invalidated_at), COUNT(*) FROM replica_state")
+	synced_at, invalidated_at, feeds = cursor.fetchone()
+	return feeds == 2 and synced_at > invalidated_at and time.time() - synced_at <= REPLICA_MAX_LAG
+
+def replica_search(product_name, category):
+	# Returns the search results from the replica, or None if it cannot answer the query.
+	cursor = get_db().cursor()
+	query = """SELECT p.name, p.price, p.category, m.username FROM replica_products p
+		LEFT JOIN replica_last_mod m ON m.name = p.name"""
+	if product_name:
+		cursor.execute(query + " WHERE p.name = ?", (product_name,))
+	else:
+		cursor.execute(query + " WHERE p.category = ? ORDER BY p.position", (category,))
+	rows = cursor.fetchall()
+
+	# A product missing here may simply not have been replicated yet.
+	if not rows or any(row[3] is None for row in rows):
+		return None
+	return [{"product_name": row[0], "price": row[1], "category": row[2], "last_mod": row[3]} for row in rows]
+
+def live_search(product_name, category, query=None, limit=None):
+	# Returns the search results from products and logs, or None if the query has no complete answer.
+	# Raises if either service cannot be reached.
+	if product_name:
+		prod_data = client.products.product(product_name=product_name)
+	elif category:
+		prod_data = client.products.product(category=category)
+	else:
+		prod_data = client.products.product(q=query, limit=limit)
+
+	if prod_data["status"] == 2 or prod_data["products"] == "NULL":
+		return None
+
+	# Translate result: unwrap the product list
+	products = prod_data["products"]
+
+	# Get last modifier info for every product with one call to the Logging microservice
+	names = [prod["product_name"] for prod in products]
+	deadline = time.monotonic() + LAST_MOD_WAIT
+	while True:
+		log_data = client.logs.last_mod(names)
+		if log_data["status"] == 2:
+			return None
+		last_mods = log_data["last_mod"]
+		if all(last_mods.get(name, "NULL") != "NULL" for name in names) or time.monotonic() >= deadline:
+			break
+		# The log event of a product written a moment ago is still being shipped.
+		time.sleep(LAST_MOD_RETRY)
+
+	results = []
+	for prod in products:
+		last_mod = last_mods.get(prod["product_name"], "NULL")
+		if last_mod == "NULL":
+			return None
+		prod["last_mod"] = last_mod
+		results.append(prod)
+	return results
+
+def find_results(product_name, category, query, limit):
+	# Returns the search results, or None if the query has no answer (status 3).
+	if not product_name and not category and not query:
+		return None
+
+	results = None
+	if product_name or category:
+		# Answer from the local replica when it is current, otherwise ask products and logs.
+		if REPLICA_ENABLED and replica_fresh():
+			results = replica_search(product_name, category)
+		if results is None:
+			try:
+				results = live_search(product_name, category)
+			except resilience.Unavailable:
+				# Products or logs is unavailable: keep serving whatever the replica holds, and
+				# answer 503 rather than "not found" if it holds nothing.
+				results = replica_search(product_name, category) if REPLICA_ENABLED else None
+				if results is None:
+					raise
+	else:
+		results = live_search(None, None, query, limit)
+	return results
+
+def apply_invalidations():
+	# Drops the entries other workers (or the replica) have invalidated since the last call,
+	# or the whole cache if the database was recreated.
+	global cache_epoch, invalidations_seen
+	cursor = get_db().cursor()
+	cursor.execute(
+		"""SELECT s.epoch, i.id, i.kind, i.value FROM cache_state s
+		LEFT JOIN cache_invalidations i ON i.id > ? ORDER BY i.id""",
+		(invalidations_seen,)
+	)
+	rows = cursor.fetchall()
+	if not rows:
+		return
+	with cache_lock:
+		ids = [row[1] for row in rows if row[1] is not None]
+		if rows[0][0] != cache_epoch:
+			search_cache.clear()
+			cache_epoch = rows[0][0]
+			invalidations_seen = max(ids, default=0)
+			return
+		stale = [(row[2], row[3]) for row in rows if row[1] is not None and row[1] > invalidations_seen]
+		if not stale:
+			return
+		invalidations_seen = max(ids)
+	if any(kind == "all" for kind, _ in stale):
+		search_cache.clear()
+		return
+	search_cache.invalidate(*stale)
+	# Any change may alter which products a full text query matches.
+	search_cache.invalidate_where(lambda key: key[0] == "q")
+
+def cache_key(product_name, category, query, limit):
+	# Normalized query: the same lookup find_results() would make.
+	if product_name:
+		return ("name", product_name)
+	if category:
+		return ("category", category)
+	if query:
+		return ("q", " ".join(query.lower().split()), limit or "")
+	return None
+
+def load_results(key, args):
+	generation = search_cache.generation()
+	started = time.time()
+	results = find_results(*args)
+	if results is not None:
+		search_cache.put(key, (started, results), generation)
+	return results
+
+def revalidate(key, args):
+	# Recomputes a stale entry in the background, once per key at a time.
+	with cache_lock:
+		if key in revalidating:
+			return
+		revalidating.add(key)
+		cache_counters["revalidations"] += 1
+
+	def run():
+		try:
+			load_results(key, args)
+		except Exception:
+			pass
+		finally:
+			with cache_lock:
+				revalidating.discard(key)
+
+	fanout.executor("revalidate").submit(run)
+
+def cached_results(product_name, category, query, limit):
+	args = (product_name, category, query, limit)
+	key = cache_key(*args)
+	if not CACHE_ENABLED or key is None:
+		return find_results(*args)
+
+	apply_invalidations()
+	entry = search_cache.get(key)
+	age = time.time() - entry[0] if entry is not MISSING else None
+	if age is not None and age <= CACHE_TTL + CACHE_STALE:
+		result = "hit" if age <= CACHE_TTL else "stale_hit"
+		with cache_lock:
+			cache_counters[result + "s"] += 1
+		metrics.registry.inc("search_cache_lookups_total", (("result", result),))
+		if age > CACHE_TTL:
+			revalidate(key, args)
+		return entry[1]
+
+	with cache_lock:
+		cache_counters["misses"] += 1
+	metrics.registry.inc("search_cache_lookups_total", (("result", "miss"),))
+	return load_results(key, args)
+
+@app.route('/ready', methods=['GET'])
+def ready():
+	if not database.ready():
+		return json.dumps({"status": 2}), 503
+	return json.dumps({"status": 1})
 
 @app.route('/clear', methods=['GET'])
 def clear():
-	if os.path.exists(db_name):
-		try:
-			os.remove(db_name)
-		except Exception as e:
-			return f"Error clearing database: {e}"
-	global db_flag
-	db_flag = False
+	create_db(reset=True)
+	clear_caches()
 	return "Database Cleared"
 
+def clear_caches(name=None):
+	search_cache.clear()
+	jwt_verifier.clear_cache()
+
+snapshots.instrument(app, database, clear_caches)
+
+@app.route('/replica/sync', methods=['POST'])
+def replica_sync():
+	try:
+		sync_replica()
+	except Exception:
+		return json.dumps({"status": 2})
+	return json.dumps({"status": 1})
+
+@app.route('/invalidate', methods=['POST'])
+def invalidate():
+	# Called by products after every write, so it only records the write and returns: the replica
+	# stops answering until the poller, woken here, has pulled the change, which keeps results
+	# recomputed after the invalidation from being read from it before then.
+	try:
+		product_names = json.loads(request.form.get("product_names", "[]"))
+		categories = json.loads(request.form.get("categories", "[]"))
+	except ValueError:
+		return json.dumps({"status": 2})
+	if not isinstance(product_names, list) or not isinstance(categories, list):
+		return json.dumps({"status": 2})
+
+	conn = get_db()
+	try:
+		cursor = conn.cursor()
+		if REPLICA_ENABLED:
+			cursor.execute("UPDATE replica_state SET invalidated_at = ?", (time.time(),))
+		if CACHE_ENABLED:
+			record_invalidations(cursor, [("name", name) for name in product_names] + [("category", category) for category in categories])
+		conn.commit()
+	except sqlite3.OperationalError:
+		conn.rollback()
+		return json.dumps({"status": 2})
+	replica_nudge.set()
+	return json.dumps({"status": 1})
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+	with cache_lock:
+		stats = dict(cache_counters)
+	lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+	stats["size"] = search_cache.stats()["size"]
+	stats["maxsize"] = search_cache.maxsize
+	stats["hit_ratio"] = (stats["hits"] + stats["stale_hits"]) / lookups if lookups else 0.0
+	return json.dumps({"status": 1, "cache": stats})
+
 @app.route('/search', methods=['GET'])
 def search():
 	# Check JWT in Authorization header
@@ -56,77 +465,35 @@ def search():
 	if not jwt_token:
 		return json.dumps({"status": 2, "data": "NULL"})
 	
-	# Verify if user exists
-	URL = "http://user:5000/verify"
-	PARAMS = {'jwt': jwt_token}
-	r = requests.get(url=URL, params=PARAMS)
-	user_data = r.json()
-	if user_data["status"] == 2:
-		return json.dumps({"status": 2, "data": "NULL"})
-
 	# Extract query parameters from URL args (GET request)
 	product_name = request.args.get('product_name')
 	category = request.args.get('category')
-	products = []
+	# Full text mode: ranked prefix matching over product names and categories.
+	query = request.args.get('q')
+	limit = request.args.get('limit')
 
-	# Depending on the parameter, call the Product Management microservice
-	try:
-		if not product_name and not category:
-			return json.dumps({"status": 3, "data": "NULL"})
-		
-		elif product_name:
-			URL = "http://products:5000/product"
-			PARAMS = {"product_name": product_name}
-			r = requests.get(url=URL, params=PARAMS)
-			prod_data = r.json()
-
-			if prod_data["status"] == 2 or prod_data["products"] == "NULL":
-				return json.dumps({"status": 3, "data": "NULL"})
-			
-			# Translate result: unwrap the product list
-			products = prod_data["products"]
-
-		elif category:
-			URL = "http://products:5000/product"
-			PARAMS = {"category": category}
-			r = requests.get(url=URL, params=PARAMS)
-			prod_data = r.json()
-
-			if prod_data["status"] == 2 or prod_data["products"] == "NULL":
-				return json.dumps({"status": 3, "data": "NULL"})
-			
-			# Translate result: unwrap the product list
-			products = prod_data["products"]
-		
-	except Exception:
+	# Check the signature locally first, so a forged token causes no downstream call, then verify
+	# that the user exists while the search runs; a failed verification still answers status 2
+	if jwt_verifier.token_username(jwt_token) is None:
+		return json.dumps({"status": 2, "data": "NULL"})
+	user_data, results = fanout.gather(
+		fanout.Call("user", lambda: jwt_verifier.verify(jwt_token), lambda data: data["status"] == 2),
+		fanout.Call("products", lambda: cached_results(product_name, category, query, limit), lambda found: found is None),
+	)
+	if user_data["status"] == 2:
+		return json.dumps({"status": 2, "data": "NULL"})
+
+	if results is None:
 		return json.dumps({"status": 3, "data": "NULL"})
-	
-	# For each product, get last modifier info from the Logging microservice
-	results = []
-	for prod in products:
-		try:
-			name = prod["product_name"]
-			URL = "http://logs:5000/last_mod"
-			PARAMS = {"product_name": name}
-			r = requests.get(url=URL, params=PARAMS)
-			log_data = r.json()
-			if log_data["status"] == 2:
-				return json.dumps({"status": 3, "data": "NULL"})
-			last_mod = log_data["last_mod"]
-		except Exception:
-			return json.dumps({"status": 3, "data": "NULL"})
-		prod["last_mod"] = last_mod
-		results.append(prod)
 
 	if product_name:
 		# Log the event for product search
-		URL = "http://logs:5000/log"
-		PARAMS = {"event": "search", "user": user_data["user"], "name": product_name}
-		log = requests.post(url=URL, data=PARAMS)
+		log_shipper.log_event("search", user_data["user"], product_name)
 	if category:
 		# Log the event for category search
-		URL = "http://logs:5000/log"
-		PARAMS = {"event": "search", "user": user_data["user"], "name": category}
-		log = requests.post(url=URL, data=PARAMS)
+		log_shipper.log_event("search", user_data["user"], category)
+	if query and not product_name and not category:
+		# Log the event for full text search
+		log_shipper.log_event("search", user_data["user"], query)
 
-	return json.dumps({"status": 1, "data": results})
\ No newline at end of file
+	return json.dumps({"status": 1, "data": results})
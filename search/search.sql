@@ -0,0 +1,50 @@
+DROP TABLE IF EXISTS replica_products;
+DROP TABLE IF EXISTS replica_last_mod;
+DROP TABLE IF EXISTS replica_state;
+DROP TABLE IF EXISTS cache_invalidations;
+DROP TABLE IF EXISTS cache_state;
+
+-- Local copy of the products catalog, fed by the products /changes feed.
+CREATE TABLE replica_products (
+    name TEXT PRIMARY KEY,
+    price REAL NOT NULL,
+    category TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    version INTEGER NOT NULL
+);
+
+CREATE INDEX replica_products_category ON replica_products (category, position);
+
+-- Local copy of the logs product_last_mod table, fed by the logs /last_mod/changes feed.
+CREATE TABLE replica_last_mod (
+    name TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    row_id INTEGER NOT NULL
+);
+
+-- Position in each feed, and when the replica last caught up with it. invalidated_at is when
+-- products last reported a write; the replica only answers once it has synced since then.
+CREATE TABLE replica_state (
+    feed TEXT PRIMARY KEY,
+    epoch TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    synced_at REAL NOT NULL,
+    invalidated_at REAL NOT NULL DEFAULT 0
+);
+
+-- Cached search results every worker process must drop: kind is "name", "category" or "all".
+CREATE TABLE cache_invalidations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+
+CREATE INDEX cache_invalidations_created_at ON cache_invalidations (created_at);
+
+-- Changes every time the database is recreated, so workers know to drop their whole cache.
+CREATE TABLE cache_state (
+    epoch TEXT NOT NULL
+);
+
+INSERT INTO cache_state (epoch) VALUES (lower(hex(randomblob(8))));
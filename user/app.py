@@ -11,33 +11,38 @@ from flask import Flask, request
 import json
 import hashlib
 import re
-import base64
-import hmac
-import requests
+from common import codec, log_shipper, metrics, resilience, snapshots, streaming, tracing
+from common.db import Database
+from common.jwt_verifier import generate_jwt, verify_jwt
 
 app = Flask(__name__)
+metrics.instrument(app, "user")
+tracing.instrument(app, "user")
+codec.instrument(app)
+resilience.instrument(app, "user")
 db_name = "users.db"
-sql_file = "users.sql"
-db_flag = False
+sql_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "users.sql")
+database = Database(db_name, sql_file)
 
-def create_db():
-	conn = sqlite3.connect(db_name)
-	with open(sql_file, 'r') as sql_startup:
-		init_db = sql_startup.read()
-	cursor = conn.cursor()
-	cursor.executescript(init_db)
-	conn.execute("PRAGMA foreign_keys = ON")
-	conn.commit()
-	conn.close()
-	global db_flag
-	db_flag = True
-	return conn
+# Records validated, checked and inserted per transaction by /create_users.
+IMPORT_CHUNK_SIZE = 1000
+# Maximum number of values bound into a single IN (...) query.
+BATCH_CHUNK_SIZE = 500
+# Text fields of an imported record; each must be a string when present.
+IMPORT_FIELDS = ("username", "first_name", "last_name", "email_address", "password", "salt")
+
+def create_db(reset=False):
+	# Idempotent: creates the schema once, or drops and recreates it with reset=True.
+	database.init_schema(reset)
 
 def get_db():
-	if not db_flag:
-		create_db()
-	conn = sqlite3.connect(db_name)
-	return conn
+	return database.get()
+
+create_db()
+
+@app.teardown_appcontext
+def release_db(exception):
+	database.release()
 
 def valid_password(username, first_name, last_name, pw, salt=""):
 	if pw is None or len(pw) < 8:
@@ -56,75 +61,38 @@ def valid_password(username, first_name, last_name, pw, salt=""):
 		return False
 	return True
 
-def generate_jwt(username):
-	# Read key from file "key.txt" in the outermost directory
-	try:
-		with open("key.txt", "r") as key_file:
-			key = key_file.readline().strip()
-	except Exception as e:
-		raise Exception("JWT key file not found or unreadable.")
-	
-	header = {"alg": "HS256", "typ": "JWT"}
-	payload = {"username": username}
-	
-	# Convert header and payload to JSON
-	header_json = json.dumps(header)
-	payload_json = json.dumps(payload)
-	
-	# Base64 URL safe encode.
-	header_b64 = base64.urlsafe_b64encode(header_json.encode('utf-8')).decode('utf-8')
-	payload_b64 = base64.urlsafe_b64encode(payload_json.encode('utf-8')).decode('utf-8')
-	
-	signing_input = f"{header_b64}.{payload_b64}"
-	
-	# Compute HMAC using the key and SHA256.
-	signature = hmac.new(key.encode('utf-8'), signing_input.encode('utf-8'), hashlib.sha256).hexdigest()
-	
-	token = f"{header_b64}.{payload_b64}.{signature}"
-	return token
-
-def verify_jwt(token):
-	try:
-		parts = token.split('.')
-		if len(parts) != 3:
-			return None
-		header_b64, payload_b64, sig = parts
-		# Recompute the signature using the header and payload.
-		try:
-			with open("key.txt", "r") as key_file:
-				key = key_file.readline().strip()
-		except Exception as e:
-			return None
-		signing_input = f"{header_b64}.{payload_b64}"
-		computed_signature = hmac.new(key.encode('utf-8'), signing_input.encode('utf-8'), hashlib.sha256).hexdigest()
-		if not hmac.compare_digest(computed_signature, sig):
-			return None
-		payload = json.loads(base64.urlsafe_b64decode(payload_b64).decode('utf-8'))
-		return payload
-	except Exception:
-		return None
-	
 @app.route('/', methods=(['GET']))
 def index():
+	if streaming.requested(request.args):
+		try:
+			after, limit = streaming.pagination_args(request.args)
+		except ValueError:
+			return json.dumps({"status": 2, "data": "NULL"})
+		rows = streaming.keyset_rows(get_db(), "SELECT rowid AS row_id, * FROM users WHERE rowid > ? ORDER BY rowid LIMIT ?", (), after, limit)
+		if streaming.wants_ndjson(request.args):
+			return streaming.ndjson_response(rows)
+		return streaming.page_response(rows, limit)
+
 	conn = get_db()
 	cursor = conn.cursor()
 	cursor.execute("SELECT * FROM users;")
 	result = cursor.fetchall()
-	conn.close()
 
 	return result
 
+@app.route('/ready', methods=['GET'])
+def ready():
+	if not database.ready():
+		return json.dumps({"status": 2}), 503
+	return json.dumps({"status": 1})
+
 @app.route('/clear', methods=['GET'])
 def clear():
-	if os.path.exists(db_name):
-		try:
-			os.remove(db_name)
-		except Exception as e:
-			return f"Error clearing database: {e}"
-	global db_flag
-	db_flag = False
+	create_db(reset=True)
 	return "Database Cleared"
 
+snapshots.instrument(app, database)
+
 @app.route('/create_user', methods=['POST'])
 def create_user():
 	# Extract form data from the request.
@@ -149,24 +117,20 @@ def create_user():
 	
 	# Check if username is NULL
 	if not username:
-		conn.close()
 		return json.dumps({"status": 2, "pass_hash": "NULL"})
 	
 	# Check if email address is NULL
 	if not email_address:
-		conn.close()
 		return json.dumps({"status": 3, "pass_hash": "NULL"})
 
 	# Check if the username already exists
 	cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
 	if cursor.fetchone() is not None:
-		conn.close()
 		return json.dumps({"status": 2, "pass_hash": "NULL"})
 	
 	# Check if the email address is already registered
 	cursor.execute("SELECT * FROM users WHERE email_address = ?", (email_address,))
 	if cursor.fetchone() is not None:
-		conn.close()
 		return json.dumps({"status": 3, "pass_hash": "NULL"})
 	
 	# Insert the new user record into the users table.
@@ -175,15 +139,11 @@ def create_user():
 		(first_name, last_name, username, email_address, employee, pass_hash, salt)
 	)
 	
-	# Commit the transaction and close the database connection.
+	# Commit the transaction.
 	conn.commit()
-	conn.close()
 
 	# Log the event
-	URL = "http://logs:5000/log"
-	PARAMS = {"event": "user_creation", "user": username, "name": "NULL"}
-	log = requests.post(url=URL, data=PARAMS)
-	log = log.json()
+	log_shipper.log_event("user_creation", username, "NULL")
 	
 	# Return success response along with the password hash.
 	return json.dumps({"status": 1, "pass_hash": pass_hash})
@@ -207,7 +167,6 @@ def login():
 	if row is None:
 		return json.dumps({"status": 2, "jwt": "NULL"})
 	salt = row[0]
-	conn.close()
 		
 	computed_hash = hashlib.sha256((password + salt).encode()).hexdigest()
 	if computed_hash != stored_hash:
@@ -220,10 +179,7 @@ def login():
 		return json.dumps({"status": 3, "jwt": "NULL", "error": str(e)})
 	
 	# Log the event
-	URL = "http://logs:5000/log"
-	PARAMS = {"event": "login", "user": username, "name": "NULL"}
-	log = requests.post(url=URL, data=PARAMS)
-	log = log.json()
+	log_shipper.log_event("login", username, "NULL")
 	
 	return json.dumps({"status": 1, "jwt": token})
 
@@ -233,16 +189,110 @@ def verify():
 	payload = verify_jwt(token)
 
 	if payload is None:
-		return json.dumps({"status": 2, "user": "NULL", "employee": "NULL"})
+		return codec.response({"status": 2, "user": "NULL", "employee": "NULL"})
 	
 	username = payload["username"]
 	conn = get_db()
 	cursor = conn.cursor()
 	cursor.execute("SELECT employee FROM users WHERE username = ?", (username,))
 	row = cursor.fetchone()
-	conn.close()
 
 	if row is None:
-		return json.dumps({"status": 2, "user": "NULL", "employee": "NULL"})
+		return codec.response({"status": 2, "user": "NULL", "employee": "NULL"})
 	employee = row[0]
-	return json.dumps({"status": 1, "user": username, "employee": employee})
\ No newline at end of file
+	return codec.response({"status": 1, "user": username, "employee": employee})
+
+def existing_values(cursor, column, values):
+	# Returns the subset of `values` already stored in `column` of the users table.
+	values = list(values)
+	found = set()
+	for start in range(0, len(values), BATCH_CHUNK_SIZE):
+		chunk = values[start:start + BATCH_CHUNK_SIZE]
+		placeholders = ", ".join("?" for _ in chunk)
+		cursor.execute(f"SELECT {column} FROM users WHERE {column} IN ({placeholders})", chunk)
+		found.update(row[0] for row in cursor.fetchall())
+	return found
+
+def import_chunk(records):
+	# Validates, checks and inserts one chunk of records with the same rules and status codes as
+	# create_user, and returns one result per record. Records create_user could not receive, with
+	# a field that is not a string or without a first or last name, get status 5.
+	results = []
+	candidates = []
+	for record in records:
+		if record is None:
+			results.append({"status": 2, "pass_hash": "NULL"})
+			continue
+		if any(not isinstance(record.get(field), (str, type(None))) for field in IMPORT_FIELDS):
+			results.append({"status": 5, "pass_hash": "NULL"})
+			continue
+		username = record.get('username')
+		first_name = record.get('first_name')
+		last_name = record.get('last_name')
+		email_address = record.get('email_address')
+		password = record.get('password')
+		salt = record.get('salt') or ""
+		if not valid_password(username, first_name, last_name, password, salt):
+			results.append({"status": 4, "pass_hash": "NULL"})
+		elif not username:
+			results.append({"status": 2, "pass_hash": "NULL"})
+		elif not email_address:
+			results.append({"status": 3, "pass_hash": "NULL"})
+		elif first_name is None or last_name is None:
+			results.append({"status": 5, "pass_hash": "NULL"})
+		else:
+			result = {"status": 1, "pass_hash": hashlib.sha256((password + salt).encode()).hexdigest()}
+			employee = "True" if record.get('employee') in [True, "true", "True", "1"] else "False"
+			candidates.append((result, (first_name, last_name, username, email_address, employee, result["pass_hash"], salt)))
+			results.append(result)
+
+	# Check uniqueness for the whole chunk at once, against the table and within the import.
+	conn = get_db()
+	cursor = conn.cursor()
+	taken_usernames = existing_values(cursor, "username", {row[2] for _, row in candidates})
+	taken_emails = existing_values(cursor, "email_address", {row[3] for _, row in candidates})
+	accepted = []
+	for result, row in candidates:
+		if row[2] in taken_usernames:
+			result.update({"status": 2, "pass_hash": "NULL"})
+		elif row[3] in taken_emails:
+			result.update({"status": 3, "pass_hash": "NULL"})
+		else:
+			taken_usernames.add(row[2])
+			taken_emails.add(row[3])
+			accepted.append((result, row))
+
+	query = "INSERT INTO users (first_name, last_name, username, email_address, employee, password, salt) VALUES (?, ?, ?, ?, ?, ?, ?)"
+	try:
+		cursor.executemany(query, [row for _, row in accepted])
+		conn.commit()
+	except sqlite3.IntegrityError:
+		# A user was created concurrently: fall back to one insert per record for this chunk.
+		conn.rollback()
+		inserted = []
+		for result, row in accepted:
+			try:
+				cursor.execute(query, row)
+				inserted.append((result, row))
+			except sqlite3.IntegrityError:
+				result.update({"status": 2, "pass_hash": "NULL"})
+		conn.commit()
+		accepted = inserted
+
+	# One batched log event per chunk.
+	log_shipper.log_events([{"event": "user_creation", "user": row[2], "name": "NULL"} for _, row in accepted])
+	return results
+
+@app.route('/create_users', methods=['POST'])
+def create_users():
+	# Bulk version of create_user. Records are processed in chunks as they are read, and one
+	# result per record is streamed back as NDJSON: {"row", "username", "status", "pass_hash"}.
+	def results():
+		row_number = 0
+		for chunk in streaming.chunks(streaming.import_records(), IMPORT_CHUNK_SIZE):
+			for record, result in zip(chunk, import_chunk(chunk)):
+				row_number += 1
+				username = record.get('username') if record else None
+				yield {"row": row_number, "username": username if username and isinstance(username, str) else "NULL", **result}
+
+	return streaming.ndjson_response(results())
@@ -8,4 +8,6 @@ CREATE TABLE users (
     employee TEXT NOT NULL,
     password TEXT NOT NULL,
     salt TEXT NOT NULL
-);
\ No newline at end of file
+);
+
+CREATE INDEX users_email_address ON users (email_address);